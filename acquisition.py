@@ -0,0 +1,124 @@
+import threading
+import time
+import numpy as np
+
+
+class RingBuffer:
+
+    """Bounded single-producer/single-consumer ring buffer of samples"""
+
+    def __init__(self, capacity, nchannels, dtype=float):
+
+        """
+        The producer only ever advances ``head`` and the consumer only ever
+        advances ``tail``, so one reader thread and the GUI thread can share the
+        buffer without a lock.
+        :param capacity: int, Maximum number of samples held before overrun
+        :param nchannels: int, Number of values in every sample
+        :param dtype: numpy dtype of the stored samples
+        """
+        self.capacity = capacity
+        self.nchannels = nchannels
+        self.buffer = np.zeros([self.capacity, self.nchannels], dtype=dtype)
+
+        # Monotonic counters, the slot index is taken modulo the capacity
+        self.head = 0
+        self.tail = 0
+
+        # Samples rejected because the consumer did not keep up
+        self.overruns = 0
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def push_many(self, samples) -> int:
+        """
+        Append a block of samples. Whatever does not fit is dropped and
+        counted as overruns.
+        :param samples: (n, nchannels) array
+        :return: int, Number of samples stored
+        """
+        n = min(len(samples), self.capacity - (self.head - self.tail))
+        self.overruns += len(samples) - n
+        start = self.head % self.capacity
+        stop = start + n
+        if stop <= self.capacity:
+            self.buffer[start:stop] = samples[:n]
+        else:
+            split = self.capacity - start
+            self.buffer[start:] = samples[:split]
+            self.buffer[:stop - self.capacity] = samples[split:n]
+        self.head += n
+        return n
+
+    def drain(self, max_items=None) -> np.ndarray:
+        """
+        Remove and return the buffered samples in arrival order
+        :param max_items: int or None, Upper bound on the number of samples returned
+        :return: (n, nchannels) array, a copy of the drained samples
+        """
+        n = self.head - self.tail
+        if max_items is not None:
+            n = min(n, max_items)
+        start = self.tail % self.capacity
+        stop = start + n
+        if stop <= self.capacity:
+            out = self.buffer[start:stop].copy()
+        else:
+            out = np.concatenate([self.buffer[start:], self.buffer[:stop - self.capacity]])
+        self.tail += n
+        return out
+
+
+class AcquisitionThread(threading.Thread):
+
+    """Reader thread that moves samples from a SerialPort into a RingBuffer"""
+
+    def __init__(self, serial_port, capacity=65536, time_base=None):
+
+        """
+        :param serial_port: SerialPort, An already opened serial port object
+        :param capacity: int, Size of the ring buffer in samples
+        :param time_base: float or None, time.monotonic() value shared by several
+        readers. If given, every sample is stored with the seconds since then in
+        an extra first column.
+        """
+        super().__init__(daemon=True)
+        self.serial_port = serial_port
+        self.time_base = time_base
+        ncolumns = self.serial_port.nchannels + (time_base is not None)
+        self.ring = RingBuffer(capacity, ncolumns)
+        self.__stop_event = threading.Event()
+
+    @property
+    def dropped(self) -> int:
+        """Lines that could not be parsed into a sample"""
+        return self.serial_port.parse_errors
+
+    @property
+    def overruns(self) -> int:
+        """Samples lost because the ring buffer was full"""
+        return self.ring.overruns
+
+    def run(self):
+        while not self.__stop_event.is_set() and self.serial_port.running:
+            data = self.serial_port.read_chunk()
+            if self.time_base is not None:
+                t = np.full([len(data), 1], time.monotonic() - self.time_base)
+                data = np.concatenate([t, data], axis=1)
+            self.ring.push_many(data)
+            self.serial_port.metrics.gauge("queue", len(self.ring))
+
+    def stop(self, timeout=2.0):
+        """
+        Ask the reader to finish and wait for it. The serial port read timeout
+        bounds how long this takes.
+        :param timeout: float, Seconds to wait for the thread to join
+        """
+        self.__stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+if __name__ == "__main__":
+    print("Background acquisition of serial port samples")
@@ -0,0 +1,481 @@
+import io
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+import numpy as np
+from serial_port import SerialPort
+from acquisition import AcquisitionThread
+from recording import RecordingWriter, CsvWriter, load_samples
+from simulated_device import SimulatedDevice, SyntheticSensor, synthetic_ellipsoid
+from instrumentation import Metrics
+from sample_store import SampleStore
+from temperature import fit_temperature_compensation
+from fit_cache import FitCache
+from refine_fit import refine_fit, magnitude_residuals
+from replay_port import ReplayPort
+from binary_protocol import encode_frames, FrameDecoder
+from utilities import parse_lines
+from fit_ellipsoid import fit_ellipsoid, fit_ellipsoid_batch, transform_mag, CalibratedStream, FIT_OK, \
+    StreamingEllipsoidFit
+
+
+class BytesPort:
+
+    """Minimal stand-in for serial.Serial reading from an in-memory byte stream"""
+
+    def __init__(self, data, os_buffer=4096):
+
+        """
+        :param data: bytes, Everything the device will send
+        :param os_buffer: int, Bytes reported as waiting at most, like a driver buffer
+        """
+        self.stream = io.BytesIO(data)
+        self.size = len(data)
+        self.os_buffer = os_buffer
+
+    @property
+    def in_waiting(self) -> int:
+        return min(self.os_buffer, self.size - self.stream.tell())
+
+    def readline(self) -> bytes:
+        return self.stream.readline()
+
+    def read(self, size=1) -> bytes:
+        return self.stream.read(size)
+
+    def isOpen(self) -> bool:
+        return self.stream.tell() < self.size
+
+    def close(self):
+        pass
+
+
+def synthetic_lines(n, nchannels=3, delimiter=",", seed=0) -> bytes:
+    """
+    CSV lines as sent by the sensor firmware
+    :param n: int, Number of lines
+    :return: bytes
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(0, 40, [n, nchannels])
+    lines = [delimiter.join("%.2f" % v for v in row) for row in data]
+    return ("\r\n".join(lines) + "\r\n").encode('utf-8')
+
+
+def check_parse_lines():
+    """Lines cut short or with blank fields are rejected, not read as -1"""
+    data, n_bad = parse_lines([b"1,2,\r", b"7,8,9\r", b"1, ,3\r", b",,\r"], 3)
+    assert n_bad == 3 and np.array_equal(data, [[7, 8, 9]]), (data, n_bad)
+    data, n_bad = parse_lines([b"1;;2;;\r", b"7;;8;;9\r"], 3, ";;")
+    assert n_bad == 1 and np.array_equal(data, [[7, 8, 9]]), (data, n_bad)
+    data, n_bad = parse_lines([b"1.5,-2,3e1\r", b" 7, 8 ,9\r"], 3)
+    assert n_bad == 0 and np.array_equal(data, [[1.5, -2, 30], [7, 8, 9]]), (data, n_bad)
+    print("check: parse_lines ok")
+
+
+def feed_in_chunks(decoder, raw, sizes=(1, 7, 13, 29, 61)):
+    """Feed a byte stream to a FrameDecoder in odd sized pieces, like a serial port hands it over"""
+    out, i, k = [], 0, 0
+    while i < len(raw):
+        out.append(decoder.feed(raw[i:i + sizes[k % len(sizes)]]))
+        i += sizes[k % len(sizes)]
+        k += 1
+    return np.concatenate(out)
+
+
+def check_binary_protocol(n=200, scale=0.01, seed=0):
+    """Frames survive the encoder and the decoder and a damaged stream is resynchronized"""
+    samples = np.random.default_rng(seed).uniform(-300, 300, [n, 3])
+
+    for values, expected in (("int16", np.round(samples / scale) * scale),
+                             ("float32", samples.astype(np.float32).astype(float))):
+        unit = scale if values == "int16" else 1.0
+        decoder = FrameDecoder(3, values, unit)
+        data = feed_in_chunks(decoder, encode_frames(samples, values=values, scale=unit))
+        assert np.allclose(data, expected, rtol=0, atol=1e-9), values
+        assert decoder.frames == n and decoder.crc_errors == 0 and decoder.lost_frames == 0, values
+
+    # One flipped value byte in frame 10, frames 50 to 52 cut out after the first bytes of 50
+    raw = bytearray(encode_frames(samples, scale=scale))
+    size = FrameDecoder(3).framesize
+    raw[10 * size + 5] ^= 0xFF
+    del raw[50 * size + 3:53 * size]
+    decoder = FrameDecoder(3, scale=scale)
+    data = feed_in_chunks(decoder, bytes(raw))
+    kept = np.delete(np.arange(n), [10, 50, 51, 52])
+    assert np.allclose(data, np.round(samples[kept] / scale) * scale, rtol=0, atol=1e-9)
+    assert decoder.crc_errors == 2 and decoder.lost_frames == 4, (decoder.crc_errors, decoder.lost_frames)
+    print("check: binary protocol ok")
+
+
+def bench_parser(n=200000, buffersize=100):
+    """Line by line fill_buffer against the chunked read_chunk parser"""
+    stream = synthetic_lines(n)
+
+    sp = SerialPort("bench", ".", buffersize=buffersize)
+    sp.serial_port = BytesPort(stream)
+    t0 = time.perf_counter()
+    for _ in range(n // buffersize):
+        sp.fill_buffer()
+    t_line = time.perf_counter() - t0
+
+    sp = SerialPort("bench", ".")
+    sp.serial_port = BytesPort(stream)
+    t0 = time.perf_counter()
+    count = 0
+    while sp.serial_port.isOpen():
+        count += len(sp.read_chunk())
+    t_chunk = time.perf_counter() - t0
+    assert count == n
+
+    print("parser: fill_buffer %10.0f samples/s" % (n / t_line))
+    print("parser: read_chunk  %10.0f samples/s (x%.1f)" % (n / t_chunk, t_line / t_chunk))
+
+
+def bench_instrumentation(n=200000, os_buffer=256):
+    """Cost of the stage timers in read_chunk, small reads make it show the most"""
+    stream = synthetic_lines(n)
+    rates = []
+    for enabled in (False, True):
+        sp = SerialPort("bench", ".", metrics=Metrics(enabled))
+        sp.serial_port = BytesPort(stream, os_buffer)
+        t0 = time.perf_counter()
+        while sp.serial_port.isOpen():
+            sp.read_chunk()
+        rates.append(n / (time.perf_counter() - t0))
+    print("instrumentation: disabled %10.0f samples/s" % rates[0])
+    print("instrumentation: enabled  %10.0f samples/s (%+.1f%%)" % (rates[1], 100 * (rates[1] / rates[0] - 1)))
+    print("    " + sp.metrics.summary().replace("\n", "\n    "))
+
+
+def bench_binary(n=200000):
+    """Chunked CSV lines against binary frames carrying the same samples"""
+    samples = np.random.default_rng(0).normal(0, 40, [n, 3])
+    streams = {"ascii": synthetic_lines(n), "binary": encode_frames(samples, scale=0.01)}
+    for protocol, stream in streams.items():
+        sp = SerialPort("bench", ".", protocol=protocol, frame_scale=0.01)
+        sp.serial_port = BytesPort(stream)
+        t0 = time.perf_counter()
+        count = 0
+        while sp.serial_port.isOpen():
+            count += len(sp.read_chunk())
+        dt = time.perf_counter() - t0
+        assert count == n
+        print("protocol: %-6s %10.0f samples/s, %5.1f bytes/sample" % (protocol, n / dt, len(stream) / n))
+
+
+def check_batch_fit(k=6, n=5000):
+    """fit_ellipsoid_batch gives the fit_ellipsoid result for every sensor of a ragged batch"""
+    X = [SyntheticSensor(radius=50, distortion=0.1, seed=i).samples(n - 100 * i) for i in range(k)]
+    U, c, status = fit_ellipsoid_batch(X)
+    for i, x in enumerate(X):
+        if status[i] != FIT_OK:
+            continue
+        U_i, c_i = fit_ellipsoid(x)
+        assert np.allclose(U[i], U_i, rtol=1e-9, atol=1e-12) and np.allclose(c[i], c_i, rtol=1e-9), i
+    assert np.count_nonzero(status == FIT_OK) >= k - 1, status
+    print("check: fit_ellipsoid_batch ok")
+
+
+def check_streaming_fit(n=20000, seed=1):
+    """StreamingEllipsoidFit fed in uneven chunks gives the fit_ellipsoid result on all the samples"""
+    X = SyntheticSensor(radius=50, distortion=0.1, seed=seed).samples(n)
+    stream = StreamingEllipsoidFit()
+    bounds = np.unique(np.random.default_rng(seed).integers(0, n, 50))
+    for chunk in np.split(X, bounds):
+        stream.update(chunk)
+    assert stream.N == n
+    U, c = stream.solve()
+    U_ref, c_ref = fit_ellipsoid(X)
+    assert np.allclose(U, U_ref, rtol=1e-9, atol=1e-12) and np.allclose(c, c_ref, rtol=1e-9), \
+        (np.abs(U - U_ref).max(), np.abs(c - c_ref).max())
+    print("check: StreamingEllipsoidFit ok")
+
+
+def bench_batch_fit(k=64, n=2000):
+    """fit_ellipsoid in a loop against fit_ellipsoid_batch over k sensors"""
+    X = np.stack([synthetic_ellipsoid(n, seed=i) for i in range(k)])
+
+    t0 = time.perf_counter()
+    for x in X:
+        fit_ellipsoid(x)
+    t_loop = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    fit_ellipsoid_batch(X)
+    t_batch = time.perf_counter() - t0
+
+    print("fit: loop  %3d sensors x %d samples %8.2f ms" % (k, n, 1e3 * t_loop))
+    print("fit: batch %3d sensors x %d samples %8.2f ms (x%.1f)" % (k, n, 1e3 * t_batch, t_loop / t_batch))
+
+
+def bench_transform(n=2000000, field=50.0):
+    """transform_mag plus a magnitude check against the fused CalibratedStream"""
+    X = synthetic_ellipsoid(n, radius=field)
+    U, c = fit_ellipsoid(X[:10000])
+    U = U * field
+
+    t0 = time.perf_counter()
+    error = np.linalg.norm(transform_mag(X, U, c), axis=1) - field
+    t_plain = time.perf_counter() - t0
+    print("transform: transform_mag      %10.0f samples/s" % (n / t_plain))
+
+    for dtype in (np.float64, np.float32):
+        stream = CalibratedStream(U, c, field, dtype=dtype)
+        out = np.empty([n, 3], dtype=dtype)
+        error = np.empty(n, dtype=dtype)
+        t0 = time.perf_counter()
+        stream.apply_chunked(X, out, error)
+        dt = time.perf_counter() - t0
+        print("transform: stream %-11s %10.0f samples/s (x%.1f)" % (np.dtype(dtype).name, n / dt, t_plain / dt))
+
+
+def bench_temperature(n=500000, field=50.0):
+    """Fit of a temperature sweep and the per sample correction against a loop over the bins"""
+    rng = np.random.default_rng(0)
+    T = rng.uniform(-20, 70, n)
+    X = synthetic_ellipsoid(n, field) * (1 + 0.002 * (T - 25))[:, None] + np.outer(T - 25, [0.2, -0.1, 0.05])
+    t0 = time.perf_counter()
+    model, table, _ = fit_temperature_compensation(X, T, field=field)
+    print("temperature: fit of %d bins %9.2f ms" % (len(table["T"]), 1e3 * (time.perf_counter() - t0)))
+
+    t0 = time.perf_counter()
+    model.apply(X, T)
+    t_model = time.perf_counter() - t0
+    # Nearest bin, calibrated bin by bin
+    index = np.clip(np.searchsorted(table["edges"], T) - 1, 0, len(table["T"]) - 1)
+    t0 = time.perf_counter()
+    out = np.empty([n, 3])
+    for k in range(len(table["T"])):
+        sel = index == k
+        out[sel] = transform_mag(X[sel], field * table["U"][k], table["c"][k])
+    t_bins = time.perf_counter() - t0
+    print("temperature: per bin loop %10.0f samples/s" % (n / t_bins))
+    print("temperature: model.apply  %10.0f samples/s (x%.1f)" % (n / t_model, t_bins / t_model))
+
+
+def bench_fit_scaling(sizes=(1000, 10000, 100000, 1000000)):
+    """Time of fit_ellipsoid against the number of samples"""
+    for n in sizes:
+        X = synthetic_ellipsoid(n)
+        t0 = time.perf_counter()
+        fit_ellipsoid(X)
+        print("fit: fit_ellipsoid N=%-8d %9.2f ms" % (n, 1e3 * (time.perf_counter() - t0)))
+
+
+def bench_persistence(n=200000, block=100):
+    """Appending the drained blocks to a text recording and to a binary one"""
+    X = synthetic_ellipsoid(n)
+    with tempfile.TemporaryDirectory() as folder:
+        for name, writer in (("csv", CsvWriter(path.join(folder, "trial.txt"))),
+                             ("mrec", RecordingWriter(path.join(folder, "trial.mrec")))):
+            t0 = time.perf_counter()
+            for i in range(0, n, block):
+                writer.append(X[i:i + block])
+            writer.close()
+            dt = time.perf_counter() - t0
+            print("persistence: %-4s %10.0f samples/s, %5.1f bytes/sample"
+                  % (name, n / dt, path.getsize(writer.filename) / n))
+
+
+def bench_sample_store(n=500000, block=100):
+    """Session samples kept in memory against reloading the text recording for a fit"""
+    X = synthetic_ellipsoid(n)
+    store = SampleStore(3)
+    t0 = time.perf_counter()
+    for i in range(0, n, block):
+        store.append(X[i:i + block], time.time())
+    t_append = time.perf_counter() - t0
+    print("store: append %10.0f samples/s" % (n / t_append))
+
+    with tempfile.TemporaryDirectory() as folder:
+        filename = path.join(folder, "trial.txt")
+        writer = CsvWriter(filename)
+        writer.append(X)
+        writer.close()
+        t0 = time.perf_counter()
+        load_samples(filename)
+        t_load = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    _ = store.samples
+    t_view = time.perf_counter() - t0
+    print("store: samples for a fit, text file %8.1f ms, store view %8.3f ms" % (1e3 * t_load, 1e3 * t_view))
+
+    for mode in ("decimate", "reservoir"):
+        bounded = SampleStore(3, max_samples=n // 10, mode=mode)
+        t0 = time.perf_counter()
+        for i in range(0, n, block):
+            bounded.append(X[i:i + block])
+        print("store: %-9s %10.0f samples/s, %d of %d kept"
+              % (mode, n / (time.perf_counter() - t0), len(bounded), n))
+
+
+def bench_fit_cache(n=500000, appended=50000):
+    """Calibrating a recording again, unchanged and after samples were appended to it"""
+    X = synthetic_ellipsoid(n + appended)
+    with tempfile.TemporaryDirectory() as folder:
+        for name, writer_class in (("trial.txt", CsvWriter), ("trial.mrec", RecordingWriter)):
+            filename = path.join(folder, name)
+            writer = writer_class(filename)
+            writer.append(X[:n])
+            writer.close()
+            cache = FitCache()
+            times = []
+            for grow in (False, False, True):
+                if grow:
+                    writer = writer_class(filename)
+                    writer.append(X[n:])
+                    writer.close()
+                t0 = time.perf_counter()
+                cache.fit(filename)
+                times.append(time.perf_counter() - t0)
+            print("fit cache: %-10s full %8.1f ms, unchanged %6.2f ms, %d appended %8.1f ms"
+                  % (name, 1e3 * times[0], 1e3 * times[1], appended, 1e3 * times[2]))
+
+
+def bench_refine(n=10000, field=50.0, distortion=0.15):
+    """Levenberg-Marquardt refinement after the closed-form fit, time and residuals"""
+    X = SyntheticSensor(radius=field, distortion=distortion, seed=1).samples(n)
+    t0 = time.perf_counter()
+    U, c = fit_ellipsoid(X)
+    t_fit = time.perf_counter() - t0
+    rms_fit = np.sqrt(np.mean(magnitude_residuals(X, U * field, c, field) ** 2))
+
+    t0 = time.perf_counter()
+    U, c, info = refine_fit(X, U, c, field)
+    t_refine = time.perf_counter() - t0
+    print("refine: %d samples, fit %6.2f ms rms %.3f, refined %6.2f ms rms %.3f in %d iterations"
+          % (n, 1e3 * t_fit, rms_fit, 1e3 * t_refine, info["rms"], info["iterations"]))
+
+
+def bench_replay(n=200000, short=2000, rate=100.0, error_rate=0.01):
+    """
+    Recordings replayed through ReplayPort and the reader thread, as fast as
+    possible and a short one at 20x its rate with jitter, repeatable unlike a device
+    """
+    X = synthetic_ellipsoid(n)
+    with tempfile.TemporaryDirectory() as folder:
+        for name, m in (("long.mrec", n), ("short.mrec", short)):
+            writer = RecordingWriter(path.join(folder, name))
+            writer.append(X[:m], np.arange(m) / rate)
+            writer.close()
+        for name, protocol, speed, jitter in (("long.mrec", "ascii", None, 0.0), ("long.mrec", "binary", None, 0.0),
+                                              ("short.mrec", "ascii", 20.0, 0.005)):
+            sp = ReplayPort(path.join(folder, name), folder, speed=speed, jitter=jitter, error_rate=error_rate,
+                            protocol=protocol, frame_scale=0.01)
+            sp.open_port()
+            acq = AcquisitionThread(sp, capacity=1 << 20)
+            t0 = time.perf_counter()
+            acq.start()
+            acq.join()
+            elapsed = time.perf_counter() - t0
+            received = len(acq.ring.drain())
+            sent = len(sp.serial_port.samples)
+            if speed is None:
+                print("replay: %-6s max speed %9.0f samples/s, %d of %d samples"
+                      % (protocol, received / elapsed, received, sent))
+            else:
+                print("replay: %-6s %gx %.2f s for %.2f s of data, %d of %d samples"
+                      % (protocol, speed, elapsed, sent / rate / speed, received, sent))
+
+
+def bench_end_to_end(n=100000, rate=None, error_rate=0.01, protocol="ascii", poll=0.02):
+    """
+    Simulated device through SerialPort, the reader thread, the live plot and
+    the recording, the same path as a GUI session
+    :param rate: float or None, Samples per second, None for as fast as possible
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from live_plot import LivePlot
+
+    device = SimulatedDevice(rate, n_samples=n, error_rate=error_rate, protocol=protocol)
+    sp = SerialPort(device.port, ".", protocol=protocol, frame_scale=0.01)
+    sp.open_port()
+    sp.serial_port.timeout = 0.05
+    reader = AcquisitionThread(sp)
+
+    fig = plt.figure()
+    plot = LivePlot(fig.add_subplot(111, projection='3d'), fig.canvas, c='r')
+
+    received = 0
+    received_log = []
+    with tempfile.TemporaryDirectory() as folder:
+        writer = RecordingWriter(path.join(folder, "trial.mrec"))
+        reader.start()
+        device.start()
+        t0 = time.monotonic()
+        idle = 0
+        while idle < 10:
+            time.sleep(poll)
+            data = reader.ring.drain()
+            plot.append(data)
+            writer.append(data)
+            received += len(data)
+            received_log.append((received, time.monotonic()))
+            idle = idle + 1 if len(data) == 0 and not device.is_alive() else 0
+        elapsed = received_log[-1 - idle][1] - t0
+        writer.close()
+    reader.stop()
+    sp.close()
+    device.close()
+    plt.close(fig)
+
+    # Latency from a block being written to all of it being drained and plotted
+    sent, t_sent = np.array(device.write_log).T
+    got, t_got = np.array(received_log).T
+    idx = np.searchsorted(got, sent)
+    done = idx < len(got)
+    latency = 1e3 * (t_got[idx[done]] - t_sent[done])
+    print("end to end: %s %s, %d samples in %.2f s, %.0f samples/s"
+          % (protocol, "max rate" if rate is None else "%.0f Hz" % rate, received, elapsed, received / elapsed))
+    print("end to end: latency median %.1f ms, p95 %.1f ms" % (np.median(latency), np.percentile(latency, 95)))
+    print("end to end: %d corrupted lines sent, %d rejected, %d lost, %d overruns"
+          % (device.corrupted, reader.dropped, device.sent - device.corrupted - received, reader.overruns))
+
+
+def bench_startup(modules=("fit_ellipsoid", "recording", "calibrate_batch", "gui"), repeat=3):
+    """
+    Import time of the entry modules in a fresh interpreter, and whether they
+    pull in Tk or matplotlib
+    """
+    code = ("import sys, time; t = time.perf_counter(); import %s; "
+            "print(time.perf_counter() - t, 'tkinter' in sys.modules, 'matplotlib' in sys.modules)")
+    for module in modules:
+        times = []
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-c", code % module], capture_output=True, text=True,
+                                 cwd=path.dirname(path.abspath(__file__))).stdout.split()
+            times.append(float(out[0]))
+        print("startup: import %-16s %7.0f ms, tkinter %-5s matplotlib %s"
+              % (module, 1e3 * np.median(times), out[1], out[2]))
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import matplotlib; matplotlib.use('Agg'); import matplotlib.pyplot as plt; "
+                                          "f = plt.figure(); f.add_subplot(121, projection='3d'); "
+                                          "f.add_subplot(122, projection='3d'); f.canvas.draw()"])
+    print("startup: deferred plot construction %7.0f ms, interpreter included" % (1e3 * (time.perf_counter() - t0)))
+
+
+if __name__ == "__main__":
+    check_parse_lines()
+    check_binary_protocol()
+    check_batch_fit()
+    check_streaming_fit()
+    bench_startup()
+    bench_parser()
+    bench_instrumentation()
+    bench_binary()
+    bench_batch_fit()
+    bench_transform()
+    bench_temperature()
+    bench_fit_scaling()
+    bench_persistence()
+    bench_sample_store()
+    bench_fit_cache()
+    bench_refine()
+    bench_replay()
+    bench_end_to_end()
+    bench_end_to_end(rate=1000, n=5000)
@@ -0,0 +1,169 @@
+# Binary framed sensor protocol, an alternative to the CSV text lines.
+# Every frame is laid out little endian as
+#   sync word (uint16, 0xA55A) | counter (uint16) | nchannels values | CRC16
+# The values are int16 or float32. The CRC is CRC-16/CCITT-FALSE over the
+# counter and the values, i.e. everything between sync word and CRC.
+
+import numpy as np
+
+SYNC_WORD = 0xA55A
+SYNC_BYTES = SYNC_WORD.to_bytes(2, 'little')
+VALUE_TYPES = {"int16": "<i2", "float32": "<f4"}
+
+
+def crc_table():
+    table = np.zeros(256, dtype=np.uint16)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xFFFF
+    return table
+
+
+CRC_TABLE = crc_table()
+
+
+def crc16(frames) -> np.ndarray:
+    """
+    CRC-16/CCITT-FALSE of many byte strings of equal length at once
+    :param frames: (k, L) uint8 array, One message per row
+    :return: (k,) uint16 array
+    """
+    crc = np.full(len(frames), 0xFFFF, dtype=np.uint16)
+    for j in range(frames.shape[1]):
+        idx = (crc >> 8) ^ frames[:, j]
+        crc = (crc << 8) ^ CRC_TABLE[idx]
+    return crc
+
+
+def frame_dtype(nchannels, values="int16") -> np.dtype:
+    """
+    Structured dtype of one frame
+    :param nchannels: int, Number of values in a frame
+    :param values: string, "int16" or "float32"
+    """
+    return np.dtype([("sync", "<u2"), ("counter", "<u2"),
+                     ("values", VALUE_TYPES[values], (nchannels,)), ("crc", "<u2")])
+
+
+def encode_frames(samples, start_counter=0, values="int16", scale=1.0) -> bytes:
+    """
+    Reference encoder for the frames the firmware sends. Useful as a
+    loopback fixture for the decoder.
+    :param samples: (n, nchannels) array of physical values
+    :param start_counter: int, Counter of the first frame
+    :param values: string, "int16" or "float32"
+    :param scale: float, Physical value of one count, samples are divided by it
+    :return: bytes
+    """
+    samples = np.atleast_2d(samples)
+    n, nchannels = samples.shape
+    dt = frame_dtype(nchannels, values)
+    frames = np.zeros(n, dtype=dt)
+    frames["sync"] = SYNC_WORD
+    frames["counter"] = (start_counter + np.arange(n)) & 0xFFFF
+    scaled = samples / scale
+    if values == "int16":
+        scaled = np.clip(np.round(scaled), -32768, 32767)
+    frames["values"] = scaled
+    raw = frames.view(np.uint8).reshape(n, dt.itemsize)
+    frames["crc"] = crc16(raw[:, 2:-2])
+    return frames.tobytes()
+
+
+class FrameDecoder:
+
+    """Incremental decoder of binary frames from a byte stream"""
+
+    def __init__(self, nchannels=3, values="int16", scale=1.0):
+
+        """
+        :param nchannels: int, Number of values in a frame
+        :param values: string, "int16" or "float32"
+        :param scale: float, Physical value of one count
+        """
+        self.nchannels = nchannels
+        self.scale = scale
+        self.dtype = frame_dtype(nchannels, values)
+        self.framesize = self.dtype.itemsize
+
+        self.__pending = b""
+        self.__last_counter = None
+
+        self.frames = 0
+        # Frames whose CRC did not match
+        self.crc_errors = 0
+        # Bytes skipped while searching for the next sync word
+        self.skipped_bytes = 0
+        # Frames missing according to the counter
+        self.lost_frames = 0
+
+    def feed(self, raw) -> np.ndarray:
+        """
+        Decode all complete frames in the stream so far. Incomplete frames are
+        kept for the next call, corrupt ones are skipped by searching for the
+        next sync word.
+        :param raw: bytes, Newly received bytes
+        :return: (n, nchannels) float array
+        """
+        buf = self.__pending + raw
+        data = np.frombuffer(buf, dtype=np.uint8)
+        last_start = len(data) - self.framesize
+        if last_start < 0:
+            self.__pending = buf
+            return np.zeros([0, self.nchannels], dtype=float)
+
+        # Every place where the sync word appears with a whole frame behind it
+        starts = np.flatnonzero((data[:last_start + 1] == SYNC_BYTES[0]) &
+                                (data[1:last_start + 2] == SYNC_BYTES[1]))
+        rows = data[starts[:, None] + np.arange(self.framesize)]
+        crc = rows[:, -2].astype(np.uint16) | (rows[:, -1].astype(np.uint16) << 8)
+        good = crc16(rows[:, 2:-2]) == crc
+
+        # Sync words inside the payload of a good frame are not frame starts.
+        # Good frames rarely overlap, only then walk the candidates to keep
+        # the non-overlapping ones.
+        keep = good
+        if np.any(np.diff(starts[good]) < self.framesize):
+            keep = np.zeros(len(starts), dtype=bool)
+            end = 0
+            for i in np.flatnonzero(good):
+                if starts[i] >= end:
+                    keep[i] = True
+                    end = starts[i] + self.framesize
+        kept = starts[keep]
+        end = kept[-1] + self.framesize if len(kept) > 0 else 0
+
+        # A bad CRC outside of the good frames is counted as a corrupt frame,
+        # one inside a good frame is just the sync pattern in the payload
+        bad = starts[~good]
+        inside = np.zeros(len(bad), dtype=bool)
+        if len(kept) > 0:
+            owner = np.searchsorted(kept, bad, side='right') - 1
+            inside = (owner >= 0) & (bad < kept[owner.clip(0)] + self.framesize)
+        self.crc_errors += int(np.count_nonzero(~inside))
+
+        # Bytes from which a frame might still be completed are kept, all
+        # other bytes outside of good frames are dropped
+        tail = max(end, last_start + 1)
+        self.skipped_bytes += tail - len(kept) * self.framesize
+        self.__pending = buf[tail:]
+
+        frames = rows[keep].copy().view(self.dtype).ravel()
+        self.frames += len(frames)
+        self.__count_gaps(frames["counter"])
+        return frames["values"].astype(float) * self.scale
+
+    def __count_gaps(self, counters):
+        if len(counters) == 0:
+            return
+        if self.__last_counter is not None:
+            counters = np.concatenate([[self.__last_counter], counters])
+        steps = np.diff(counters.astype(np.int64)) & 0xFFFF
+        self.lost_frames += int((steps - 1).clip(0).sum())
+        self.__last_counter = counters[-1]
+
+
+if __name__ == "__main__":
+    print("Encoder and decoder of the binary framed sensor protocol")
@@ -0,0 +1,219 @@
+import argparse
+import glob
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import path, makedirs, cpu_count
+import numpy as np
+from fit_ellipsoid import fit_ellipsoid, transform_mag
+from recording import load_samples
+from robust_fit import fit_ellipsoid_robust
+from orientation_coverage import thin_samples
+from temperature import fit_temperature_compensation
+from calibration_store import CalibrationStore, recording_hash
+from refine_fit import refine_fit
+
+
+def find_recordings(sources, pattern="*.txt"):
+    """
+    Expand directories and glob patterns into a sorted list of files
+    :param sources: list of strings, Files, directories or glob patterns
+    :param pattern: string, Pattern of the recordings inside a directory
+    :return: list of file names
+    """
+    files = set()
+    for source in sources:
+        if path.isdir(source):
+            files.update(glob.glob(path.join(source, pattern)))
+        else:
+            files.update(glob.glob(source))
+    return sorted(f for f in files if path.isfile(f))
+
+
+def calibrate_file(filename, delimiter=",", field=50.0, robust=False, per_cell=None,
+                   temperature=None, bin_width=5.0, refine=False) -> dict:
+    """
+    Fit one recording and report the residuals of the calibrated magnitudes
+    :param filename: string, Text or binary recording of the x, y and z values
+    :param delimiter: string, Delimiter in the recording
+    :param field: float, Magnitude of the magnetic field during the recording
+    :param robust: bool, Reject outliers with fit_ellipsoid_robust
+    :param per_cell: int or None, Fit a balanced subset with at most this many samples per direction
+    :param temperature: int or None, Column of the temperature. If given a
+    temperature compensated model is fitted, U and c are then its values at
+    the mean temperature.
+    :param bin_width: float, Width of the temperature bins in degrees
+    :param refine: bool, Refine the closed-form fit by nonlinear least squares
+    and report the standard errors of U and c, not for temperature models
+    :return: dict with the device name, status, U, c and residual statistics
+    """
+    result = {"device": path.splitext(path.basename(filename))[0], "file": filename,
+              "samples": 0, "status": "ok", "U": None, "c": None, "B": field,
+              "rms_residual": np.nan, "max_residual": np.nan, "outliers": 0, "temperature_model": None,
+              "method": "temperature" if temperature is not None else "robust" if robust else "fit",
+              "hash": None, "U_std": None, "c_std": None}
+    try:
+        data = load_samples(filename, delimiter)
+        result["hash"] = recording_hash(filename)
+    except (OSError, ValueError) as e:
+        result["status"] = "unreadable: %s" % e
+        return result
+    result["samples"] = len(data)
+    columns = 3 if temperature is None else max(3, temperature + 1)
+    if data.ndim != 2 or data.shape[1] < columns:
+        result["status"] = "unreadable: %d values per sample, %d needed" % (data.shape[-1] if data.ndim > 1 else 1,
+                                                                           columns)
+        return result
+    try:
+        fit_samples(data, result, field, robust, per_cell, temperature, bin_width, refine)
+    except Exception as e:
+        # One bad recording must not take the results of the others down with it
+        result["status"] = "fit failed: %s: %s" % (type(e).__name__, e)
+    return result
+
+
+def fit_samples(data, result, field, robust, per_cell, temperature, bin_width, refine):
+    """
+    The fit part of calibrate_file, fills in the result dict
+    :param data: (n, >=3) array of samples
+    :param result: dict, Result of calibrate_file
+    """
+    if per_cell is not None:
+        data = thin_samples(data, per_cell)
+
+    inliers = np.ones(len(data), dtype=bool)
+    if temperature is not None:
+        T = data[:, temperature]
+        model, _, inliers = fit_temperature_compensation(data, T, bin_width, field=field,
+                                                         reject=0.05 if robust else None)
+        if model is None:
+            result["status"] = "fit failed"
+            return
+        U, c = model.evaluate(model.t0)
+        calibrated = model.apply(data[inliers], T[inliers])
+        result["temperature_model"] = model.to_dict()
+    else:
+        if robust:
+            params = fit_ellipsoid_robust(data)
+            if params is not None:
+                U, c, inliers, _ = params
+                params = U, c
+        else:
+            params = fit_ellipsoid(data)
+        if params is None:
+            result["status"] = "fit failed"
+            return
+        U, c = params
+        if refine:
+            refined = refine_fit(data[inliers], U, c, field)
+            if refined is not None:
+                U, c, info = refined
+                result["method"] += "+refine"
+                result["U_std"] = info["U_std"].tolist()
+                result["c_std"] = info["c_std"].tolist()
+            else:
+                U = U * field
+        else:
+            U = U * field
+        calibrated = transform_mag(data[inliers, :3], U, c)
+    residual = np.linalg.norm(calibrated, axis=1) - field
+    result["outliers"] = int(np.count_nonzero(~inliers))
+    result.update({"U": U.tolist(), "c": c.tolist(),
+                   "rms_residual": float(np.sqrt(np.mean(residual ** 2))),
+                   "max_residual": float(np.abs(residual).max())})
+
+
+def write_results(results, outdir):
+    """
+    One parameters file per device and a summary table of all of them
+    :param results: list of dicts from calibrate_file
+    :param outdir: string, Folder for the output files
+    """
+    makedirs(outdir, exist_ok=True)
+    for result in results:
+        if result["status"] == "ok":
+            params = {"U": result["U"], "c": result["c"], "B": result["B"]}
+            if result["temperature_model"] is not None:
+                params["temperature"] = result["temperature_model"]
+            if result["U_std"] is not None:
+                params.update({"U_std": result["U_std"], "c_std": result["c_std"]})
+            with open(path.join(outdir, result["device"] + ".json"), "w") as f:
+                f.write(json.dumps(params, indent=4))
+
+    with open(path.join(outdir, "summary.csv"), "w") as f:
+        f.write("device,samples,outliers,status,rms_residual,max_residual,file\n")
+        for r in results:
+            f.write("%s,%d,%d,%s,%.6g,%.6g,%s\n" % (r["device"], r["samples"], r["outliers"],
+                                                    r["status"].replace(",", ";"), r["rms_residual"],
+                                                    r["max_residual"], r["file"]))
+
+
+def store_results(results, database) -> int:
+    """
+    Add the successful calibrations to a calibration database
+    :param results: list of dicts from calibrate_file
+    :param database: string, SQLite file
+    :return: int, Number of calibrations stored
+    """
+    created = time.time()
+    records = []
+    for r in results:
+        if r["status"] != "ok":
+            continue
+        extra = {}
+        if r["temperature_model"] is not None:
+            extra["temperature"] = r["temperature_model"]
+        if r["U_std"] is not None:
+            extra["uncertainty"] = {"U_std": r["U_std"], "c_std": r["c_std"]}
+        records.append({"device": r["device"], "created": created, "field": r["B"], "U": r["U"], "c": r["c"],
+                        "method": r["method"], "samples": r["samples"], "outliers": r["outliers"],
+                        "rms_residual": r["rms_residual"], "max_residual": r["max_residual"],
+                        "recording": r["file"], "recording_hash": r["hash"], "extra": extra or None})
+    with CalibrationStore(database) as store:
+        return store.add_many(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate many magnetometer recordings at once")
+    parser.add_argument("sources", nargs="+", help="Recordings, folders or glob patterns")
+    parser.add_argument("-o", "--output", default="calibration", help="Output folder")
+    parser.add_argument("-d", "--delimiter", default=",", help="Delimiter in the recordings")
+    parser.add_argument("-B", "--field", type=float, default=50.0, help="Expected magnetic field magnitude")
+    parser.add_argument("-p", "--pattern", default="*.txt", help="Recordings to pick from a folder")
+    parser.add_argument("-r", "--robust", action="store_true", help="Reject outliers before fitting")
+    parser.add_argument("-t", "--thin", type=int, default=None,
+                        help="Fit at most this many samples per direction")
+    parser.add_argument("-T", "--temperature", type=int, default=None,
+                        help="Column holding the temperature, fits a temperature compensated model")
+    parser.add_argument("-w", "--bin-width", type=float, default=5.0, help="Width of the temperature bins")
+    parser.add_argument("-R", "--refine", action="store_true",
+                        help="Refine the fits by nonlinear least squares and report their uncertainty")
+    parser.add_argument("-s", "--database", default=None, help="Also add the calibrations to this database")
+    parser.add_argument("-j", "--jobs", type=int, default=cpu_count(), help="Number of worker processes")
+    args = parser.parse_args()
+
+    files = find_recordings(args.sources, args.pattern)
+    if len(files) == 0:
+        print("No recordings found")
+        return 1
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        results = list(pool.map(calibrate_file, files, [args.delimiter] * len(files),
+                                [args.field] * len(files), [args.robust] * len(files),
+                                [args.thin] * len(files), [args.temperature] * len(files),
+                                [args.bin_width] * len(files), [args.refine] * len(files),
+                                chunksize=max(1, len(files) // (4 * args.jobs))))
+    write_results(results, args.output)
+    if args.database is not None:
+        store_results(results, args.database)
+
+    failed = [r for r in results if r["status"] != "ok"]
+    print("Calibrated %d of %d recordings, results in %s" % (len(results) - len(failed), len(results), args.output))
+    for r in failed:
+        print("  %s: %s" % (r["device"], r["status"]))
+    return 0 if len(failed) == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+# Database of calibrations, an SQLite file with one row per calibration keyed
+# by device and time. U and c are stored as little endian float64 blobs so
+# nothing is rounded, together with the fit quality and a SHA-256 of the
+# recording they came from. Calibrations are only ever added, the latest
+# one of a device is the one in use.
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+import numpy as np
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calibrations (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    created REAL NOT NULL,
+    field REAL,
+    U BLOB NOT NULL,
+    c BLOB NOT NULL,
+    method TEXT,
+    samples INTEGER,
+    outliers INTEGER,
+    rms_residual REAL,
+    max_residual REAL,
+    recording TEXT,
+    recording_hash TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS calibrations_device ON calibrations (device, created);
+"""
+
+COLUMNS = ("device", "created", "field", "U", "c", "method", "samples", "outliers",
+           "rms_residual", "max_residual", "recording", "recording_hash", "extra")
+
+# Layout of the firmware export, one record per device after a 16 byte header
+EXPORT_MAGIC = b"MAGCAL1\0"
+EXPORT_DTYPE = np.dtype([("device", "S32"), ("created", "<f8"), ("field", "<f4"),
+                         ("U", "<f4", (3, 3)), ("c", "<f4", (3,))])
+
+
+def recording_hash(filename, block=1 << 20) -> str:
+    """
+    :param filename: string, Recording the calibration was fitted on
+    :return: string, Hex SHA-256 of the file
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CalibrationStore:
+
+    """Calibrations of many devices in one SQLite file"""
+
+    def __init__(self, filename):
+
+        """
+        :param filename: string, Database file, created if missing
+        """
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError("%s was written by a newer version (schema %d)" % (filename, version))
+        self.db.executescript(SCHEMA)
+        self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def __row(record):
+        extra = record.get("extra")
+        return (record["device"], record.get("created") or time.time(), record.get("field"),
+                np.asarray(record["U"], dtype="<f8").reshape(3, 3).tobytes(),
+                np.asarray(record["c"], dtype="<f8").reshape(3).tobytes(),
+                record.get("method", "fit"), record.get("samples"), record.get("outliers"),
+                record.get("rms_residual"), record.get("max_residual"),
+                record.get("recording"), record.get("recording_hash"),
+                None if extra is None else json.dumps(extra))
+
+    @staticmethod
+    def __record(row):
+        record = dict(zip(("id",) + COLUMNS, row))
+        record["U"] = np.frombuffer(record["U"], dtype="<f8").reshape(3, 3).copy()
+        record["c"] = np.frombuffer(record["c"], dtype="<f8").copy()
+        if record["extra"] is not None:
+            record["extra"] = json.loads(record["extra"])
+        return record
+
+    def add(self, device, U, c, **kwargs) -> int:
+        """
+        Store one calibration
+        :param device: string, Device serial
+        :param U: (3, 3) array, Calibration matrix scaled to the field
+        :param c: (3,) array, Offset vector
+        :param kwargs: Any of created (unix time, default now), field, method,
+        samples, outliers, rms_residual, max_residual, recording, recording_hash
+        and extra, a JSON serializable dict such as a temperature model
+        :return: int, Row id
+        """
+        record = dict(kwargs, device=device, U=U, c=c)
+        with self.db:
+            cursor = self.db.execute("INSERT INTO calibrations (%s) VALUES (%s)"
+                                     % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                                     self.__row(record))
+        return cursor.lastrowid
+
+    def add_many(self, records) -> int:
+        """
+        Store many calibrations in one transaction
+        :param records: iterable of dicts with the keys of add
+        :return: int, Number of calibrations stored
+        """
+        rows = [self.__row(r) for r in records]
+        with self.db:
+            self.db.executemany("INSERT INTO calibrations (%s) VALUES (%s)"
+                                % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))), rows)
+        return len(rows)
+
+    def latest(self, device):
+        """
+        :param device: string, Device serial
+        :return: dict of the newest calibration of the device or None
+        """
+        row = self.db.execute("SELECT id, %s FROM calibrations WHERE device = ? "
+                              "ORDER BY created DESC, id DESC LIMIT 1" % ", ".join(COLUMNS), (device,)).fetchone()
+        return None if row is None else self.__record(row)
+
+    def latest_all(self) -> dict:
+        """
+        :return: dict of device serial to its newest calibration
+        """
+        rows = self.db.execute(
+            "SELECT id, %s FROM calibrations AS a WHERE id = (SELECT b.id FROM calibrations AS b "
+            "WHERE b.device = a.device ORDER BY b.created DESC, b.id DESC LIMIT 1) ORDER BY device"
+            % ", ".join(COLUMNS)).fetchall()
+        return {row[1]: self.__record(row) for row in rows}
+
+    def history(self, device) -> list:
+        """
+        :param device: string, Device serial
+        :return: list of all calibrations of the device, oldest first
+        """
+        rows = self.db.execute("SELECT id, %s FROM calibrations WHERE device = ? ORDER BY created, id"
+                               % ", ".join(COLUMNS), (device,)).fetchall()
+        return [self.__record(row) for row in rows]
+
+    def devices(self) -> list:
+        return [row[0] for row in self.db.execute("SELECT DISTINCT device FROM calibrations ORDER BY device")]
+
+
+def record_to_json(record) -> dict:
+    """
+    JSON serializable copy of a calibration, floats keep full precision
+    :param record: dict from CalibrationStore
+    """
+    return {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in record.items()}
+
+
+def export_firmware(records, filename):
+    """
+    Binary table for the firmware: the magic, a little endian uint32 version
+    and uint32 count, then one EXPORT_DTYPE record per device with float32
+    values, as the sensors compute in single precision
+    :param records: iterable of dicts from CalibrationStore
+    :param filename: string
+    """
+    records = list(records)
+    table = np.zeros(len(records), dtype=EXPORT_DTYPE)
+    for row, record in zip(table, records):
+        row["device"] = record["device"].encode("utf-8")[:32]
+        row["created"] = record["created"]
+        row["field"] = np.nan if record["field"] is None else record["field"]
+        row["U"] = record["U"]
+        row["c"] = record["c"]
+    with open(filename, "wb") as f:
+        f.write(EXPORT_MAGIC + SCHEMA_VERSION.to_bytes(4, "little") + len(table).to_bytes(4, "little"))
+        f.write(table.tobytes())
+
+
+def export_header(record, filename):
+    """
+    C header with the calibration of one device
+    :param record: dict from CalibrationStore
+    :param filename: string
+    """
+    def values(a):
+        return ", ".join("%.9ef" % v for v in np.ravel(a))
+
+    rows = ",\n    ".join("{%s}" % values(u) for u in record["U"])
+    with open(filename, "w") as f:
+        f.write("/* Magnetometer calibration of %s, %s */\n"
+                % (record["device"], time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(record["created"]))))
+        f.write("/* calibrated = (raw - MAG_OFFSET) * MAG_MATRIX */\n")
+        f.write("static const float MAG_MATRIX[3][3] = {\n    %s};\n" % rows)
+        f.write("static const float MAG_OFFSET[3] = {%s};\n" % values(record["c"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query and export the calibration database")
+    parser.add_argument("database", help="SQLite file")
+    sub = parser.add_subparsers(dest="command", required=True)
+    show = sub.add_parser("show", help="Latest calibration of every device or the history of one")
+    show.add_argument("device", nargs="?", help="Device serial")
+    export = sub.add_parser("export", help="Latest calibrations for the firmware")
+    export.add_argument("output", help="Binary table, a C header if it ends in .h, or JSON if it ends in .json")
+    export.add_argument("devices", nargs="*", help="Device serials, all if none are given")
+    args = parser.parse_args()
+
+    with CalibrationStore(args.database) as store:
+        if args.command == "show":
+            records = store.history(args.device) if args.device else list(store.latest_all().values())
+            for r in records:
+                print("%-20s %s  rms %.4g  %s" % (r["device"], time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                            time.localtime(r["created"])),
+                                                 np.nan if r["rms_residual"] is None else r["rms_residual"],
+                                                 r["recording"] or ""))
+            return 0
+        latest = store.latest_all()
+        devices = args.devices or list(latest)
+        missing = [d for d in devices if d not in latest]
+        if len(missing) > 0:
+            print("No calibration for %s" % ", ".join(missing))
+            return 1
+        records = [latest[d] for d in devices]
+        if args.output.endswith(".h"):
+            if len(records) != 1:
+                print("A header holds one device")
+                return 1
+            export_header(records[0], args.output)
+        elif args.output.endswith(".json"):
+            with open(args.output, "w") as f:
+                json.dump([record_to_json(r) for r in records], f, indent=4)
+        else:
+            export_firmware(records, args.output)
+        print("Exported %d calibrations" % len(records))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
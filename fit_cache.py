@@ -0,0 +1,221 @@
+# Memoized calibration fits. Results are keyed by the recording and the fit
+# options and checked against a signature of the file, its size, modification
+# time and digests of its first and last block. All fits are stored for a
+# field of 1 since U scales linearly with |B|, so changing the field never
+# needs a refit. For the plain fit the 10x10 R factor of the design matrix is
+# kept as well, a recording that has only been appended to since is updated
+# with the new samples instead of being fitted again.
+
+import hashlib
+import json
+import os
+import sys
+from collections import OrderedDict
+from os import path, makedirs
+import numpy as np
+from fit_ellipsoid import design_matrix, ellipsoid_parameters
+from recording import is_recording, open_recording, load_samples
+from utilities import parse_lines
+
+# Bytes hashed at both ends of the file for the signature
+SIGNATURE_BLOCK = 65536
+
+
+def user_cache_file(name="fit_cache.json") -> str:
+    """
+    :param name: string, File name
+    :return: string, Path of the file in the per user cache folder of the platform
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or path.expanduser("~")
+    elif sys.platform == "darwin":
+        base = path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or path.expanduser("~/.cache")
+    return path.join(base, "magcal", name)
+
+
+def block_digest(f, start, stop) -> str:
+    f.seek(start)
+    return hashlib.sha256(f.read(stop - start)).hexdigest()
+
+
+def file_signature(filename, size=None) -> dict:
+    """
+    Cheap identity of a recording, or of its first size bytes
+    :param filename: string
+    :param size: int or None, Length of the prefix, the whole file by default
+    :return: dict of the size, modification time and head and tail digests
+    """
+    st = os.stat(filename)
+    size = st.st_size if size is None else size
+    with open(filename, "rb") as f:
+        head = block_digest(f, 0, min(size, SIGNATURE_BLOCK))
+        tail = block_digest(f, max(0, size - SIGNATURE_BLOCK), size)
+    return {"size": size, "mtime": st.st_mtime_ns, "head": head, "tail": tail}
+
+
+def is_prefix(old, filename, new) -> bool:
+    """
+    Whether a file with signature new grew from the one with signature old
+    without the first old["size"] bytes changing, as far as the digests tell
+    """
+    if new["size"] <= old["size"]:
+        return False
+    prefix = file_signature(filename, old["size"])
+    return prefix["head"] == old["head"] and prefix["tail"] == old["tail"]
+
+
+class FitCache:
+
+    """LRU cache of calibration fits, optionally kept in a JSON file"""
+
+    def __init__(self, max_entries=64, filename=None):
+
+        """
+        :param max_entries: int, Fits kept before the least recently used is dropped
+        :param filename: string or None, File the cache is loaded from and saved to
+        """
+        self.max_entries = max_entries
+        self.filename = filename
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if filename is not None and path.isfile(filename):
+            try:
+                with open(filename) as f:
+                    for entry in json.load(f):
+                        self.entries[entry["key"]] = entry
+            except (OSError, ValueError, KeyError):
+                # A broken cache is just an empty one
+                self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(filename, options) -> str:
+        """
+        :param filename: string, Recording
+        :param options: dict, Everything besides the samples that changes the fit
+        """
+        return json.dumps([path.realpath(filename), options], sort_keys=True)
+
+    def __lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def __store(self, entry):
+        self.entries[entry["key"]] = entry
+        self.entries.move_to_end(entry["key"])
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, filename, options, signature=None):
+        """
+        :param filename: string, Recording
+        :param options: dict, Fit options
+        :param signature: dict or None, file_signature of the recording if already known
+        :return: U and c for a field of 1 and the extra dict of the fit, or None
+        """
+        entry = self.__lookup(self.key(filename, options))
+        signature = file_signature(filename) if signature is None else signature
+        if entry is None or entry["signature"] != signature:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.array(entry["U"]), np.array(entry["c"]), entry["extra"]
+
+    def put(self, filename, options, U, c, extra=None, signature=None, R=None, rows=None, channels=None):
+        """
+        :param U: (3, 3) array, Calibration matrix for a field of 1
+        :param c: (3,) array, Offset vector
+        :param extra: dict or None, JSON serializable results of the fit besides U and c
+        :param R: (10, 10) array or None, R factor of the design matrix for incremental updates
+        :param rows: int or None, Samples R was computed from
+        :param channels: int or None, Values per sample of the recording, e.g. 4 with a temperature
+        """
+        self.__store({"key": self.key(filename, options),
+                      "signature": file_signature(filename) if signature is None else signature,
+                      "U": np.asarray(U).tolist(), "c": np.asarray(c).tolist(), "extra": extra,
+                      "R": None if R is None else R.tolist(), "rows": rows, "channels": channels})
+
+    def fit(self, filename, delimiter=",", data=None):
+        """
+        Plain fit_ellipsoid of a recording through the cache. If the recording
+        has only grown since it was last fitted, just the new samples are
+        read, or taken from data, and folded into the kept R factor.
+        :param filename: string, Recording
+        :param delimiter: string, Delimiter of text recordings
+        :param data: (n, >=3) array or None, The samples of the recording if
+        already loaded, they have to be exactly the rows of the file
+        :return: U and c for a field of 1, or None if the fit fails
+        """
+        options = {"method": "fit", "delimiter": delimiter}
+        key = self.key(filename, options)
+        signature = file_signature(filename)
+        entry = self.__lookup(key)
+        if entry is not None and entry["signature"] == signature:
+            self.hits += 1
+            return np.array(entry["U"]), np.array(entry["c"])
+        self.misses += 1
+
+        R = None
+        rows = 0
+        channels = None
+        if entry is not None and entry["R"] is not None and is_prefix(entry["signature"], filename, signature):
+            new = self.__appended(filename, delimiter, entry, data)
+            if new is not None:
+                R = np.linalg.qr(np.concatenate([np.array(entry["R"]), design_matrix(new)]), mode='r')
+                rows = entry["rows"] + len(new)
+                channels = entry.get("channels")
+        if R is None:
+            data = load_samples(filename, delimiter) if data is None else data
+            if len(data) < 10:
+                print("Too few values to perform fitting")
+                return None
+            R = np.linalg.qr(design_matrix(data), mode='r')
+            rows = len(data)
+            channels = data.shape[1]
+        params = ellipsoid_parameters(R)
+        if params is None:
+            return None
+        self.put(filename, options, *params, signature=signature, R=R, rows=rows, channels=channels)
+        return params
+
+    @staticmethod
+    def __appended(filename, delimiter, entry, data):
+        # Samples after the ones the entry was fitted on, None if they cannot be told apart
+        if data is not None:
+            return data[entry["rows"]:]
+        if is_recording(filename):
+            _, rows = open_recording(filename)
+            return rows["x"][entry["rows"]:]
+        with open(filename, "rb") as f:
+            f.seek(entry["signature"]["size"] - 1)
+            raw = f.read()
+        # The old end has to be the end of a line
+        if not raw.startswith(b"\n"):
+            return None
+        lines = raw[1:].splitlines()
+        # Entries from before the channel count was kept fall back to a full fit
+        if entry.get("channels") is None:
+            return None
+        new, n_bad = parse_lines(lines, entry["channels"], delimiter)
+        return None if n_bad > 0 else new
+
+    def save(self):
+        """Write the cache to its file, replacing it atomically"""
+        if self.filename is None:
+            return
+        makedirs(path.dirname(path.abspath(self.filename)), exist_ok=True)
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(list(self.entries.values()), f)
+        os.replace(tmp, self.filename)
+
+
+if __name__ == "__main__":
+    print("Cache of calibration fits")
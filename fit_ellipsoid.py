@@ -8,17 +8,13 @@
 
 import numpy as np
 
+# Status codes of the batched fit
+FIT_OK = 0
+FIT_TOO_FEW = 1
+FIT_NOT_ELLIPSOID = 2
 
-def fit_ellipsoid(X):
 
-    if len(X.shape) == 2:
-        N, _ = X.shape
-        if N < 10:
-            print("Too few values to perform fitting")
-            return None
-    else:
-        print("Data is empty or missing")
-        return None
+def design_matrix(X):
 
     x = X[:, 0].reshape(-1, 1)
     y = X[:, 1].reshape(-1, 1)
@@ -30,10 +26,12 @@ def fit_ellipsoid(X):
         x * y, x * z, y * z,
         x, y, z,
         np.ones_like(x)]
-    D = np.concatenate(D_list, axis=1)
+    return np.concatenate(D_list, axis=1)
+
+
+def ellipsoid_parameters(D_tri, verbose=True):
 
     # Only upper triangular matrix (simplifying the Eigenvalue problem)
-    Q, D_tri = np.linalg.qr(D)
     U, S, V = np.linalg.svd(D_tri)
     p = V[-1, :]
 
@@ -52,7 +50,8 @@ def fit_ellipsoid(X):
     try:
         U = np.linalg.cholesky(A).T
     except np.linalg.LinAlgError:
-        print("Unable to perform Cholesky decomposition. Need more data or retake trial")
+        if verbose:
+            print("Unable to perform Cholesky decomposition. Need more data or retake trial")
         return None
 
     # Not yet sure what this is about
@@ -72,7 +71,189 @@ def fit_ellipsoid(X):
     return U, c
 
 
-def transform_mag(X, U, c):
+def fit_ellipsoid(X):
+
+    if len(X.shape) == 2:
+        N, _ = X.shape
+        if N < 10:
+            print("Too few values to perform fitting")
+            return None
+    else:
+        print("Data is empty or missing")
+        return None
+
+    D = design_matrix(X)
+    Q, D_tri = np.linalg.qr(D)
+    return ellipsoid_parameters(D_tri)
+
+
+def fit_ellipsoid_batch(X):
+
+    """
+    Fit many sensors at once. Same estimator as fit_ellipsoid, vectorized over
+    the sensors. The design matrix D of every sensor is formed in centered and
+    scaled coordinates, D = D_n T with the monomial change of variables T, so
+    D^T D of the well-conditioned D_n can be Cholesky factored safely. R_n T
+    then has the same right singular vectors as D itself.
+    :param X: (K, N, >=3) array or list of K arrays of shape (N_k, >=3)
+    :return: U (K, 3, 3), c (K, 3) and status (K,) holding FIT_OK, FIT_TOO_FEW
+    or FIT_NOT_ELLIPSOID. U and c are NaN where the fit failed.
+    """
+    if isinstance(X, np.ndarray) and X.ndim == 3:
+        data = X[:, :, :3].astype(float)
+        mask = np.ones(data.shape[:2], dtype=bool)
+    else:
+        counts = [len(x) for x in X]
+        data = np.zeros([len(X), max(counts, default=0), 3])
+        mask = np.zeros(data.shape[:2], dtype=bool)
+        for k, x in enumerate(X):
+            data[k, :len(x)] = np.asarray(x)[:, :3]
+            mask[k, :len(x)] = True
+    counts = mask.sum(axis=1)
+    status = np.where(counts < 10, FIT_TOO_FEW, FIT_OK)
+
+    # Normalize x_n = (x - m) / s, padding samples end up all zero in D_n.
+    # Everything is laid out as (K, column, N), so every column is contiguous.
+    n = np.maximum(counts, 1)[:, None]
+    xn = data.transpose(0, 2, 1).copy()
+    m = xn.sum(axis=2) / n
+    xn -= m[:, :, None]
+    xn *= mask[:, None, :]
+    s = np.sqrt(np.einsum('kin,kin->k', xn, xn) / n[:, 0])
+    s[s == 0] = 1
+    xn /= s[:, None, None]
+    Dt = np.empty([len(data), 10, data.shape[1]])
+    np.multiply(xn, xn, out=Dt[:, 0:3])
+    np.multiply(xn[:, :1], xn[:, 1:], out=Dt[:, 3:5])
+    np.multiply(xn[:, 1], xn[:, 2], out=Dt[:, 5])
+    Dt[:, 6:9] = xn
+    Dt[:, 9] = mask
+
+    # R factors of D_n from the normal matrices
+    M = np.matmul(Dt, Dt.transpose(0, 2, 1))
+    M[status != FIT_OK] = np.eye(10)
+    try:
+        R = np.linalg.cholesky(M).transpose(0, 2, 1)
+    except np.linalg.LinAlgError:
+        # Degenerate data of some sensor, D_n itself is rank deficient
+        R = np.linalg.qr(Dt.transpose(0, 2, 1), mode='r')
+
+    # The last right singular vector of R_n T is the quadric in the original coordinates
+    p = np.linalg.svd(np.matmul(R, monomial_transform(m, s)))[2][:, -1, :]
+
+    U, c, fit_status = ellipsoid_parameters_batch(p)
+    status = np.where(status == FIT_OK, fit_status, status)
+    U[status != FIT_OK] = np.nan
+    c[status != FIT_OK] = np.nan
+    return U, c, status
+
+
+def monomial_transform(m, s):
+
+    """
+    Change of variables of the design matrix columns, the monomials of
+    x = m + s x_n in terms of the monomials of x_n
+    :param m: (K, 3) array of centers
+    :param s: (K,) array of scales
+    :return: (K, 10, 10) array T with design_matrix(x) = design_matrix(x_n) T
+    """
+    T = np.zeros([len(m), 10, 10])
+    for j, (a, b) in enumerate([(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]):
+        # x_a x_b = s^2 xn_a xn_b + s m_b xn_a + s m_a xn_b + m_a m_b
+        T[:, j, j] = s ** 2
+        T[:, 6 + a, j] += s * m[:, b]
+        T[:, 6 + b, j] += s * m[:, a]
+        T[:, 9, j] = m[:, a] * m[:, b]
+    for a in range(3):
+        T[:, 6 + a, 6 + a] = s
+        T[:, 9, 6 + a] = m[:, a]
+    T[:, 9, 9] = 1
+    return T
+
+
+def ellipsoid_parameters_batch(p):
+
+    """
+    Vectorized ellipsoid_parameters for a stack of quadrics
+    :param p: (K, 10) array of quadric coefficients
+    :return: U (K, 3, 3), c (K, 3) and status (K,)
+    """
+    p = np.where(p[:, :1] < 0, -p, p)
+    A = np.stack([
+        np.stack([p[:, 0], p[:, 3] / 2, p[:, 4] / 2], axis=-1),
+        np.stack([p[:, 3] / 2, p[:, 1], p[:, 5] / 2], axis=-1),
+        np.stack([p[:, 4] / 2, p[:, 5] / 2, p[:, 2]], axis=-1)], axis=1)
+
+    # Cholesky fails on the whole stack if one matrix is not positive
+    # definite, so those are flagged and replaced beforehand
+    status = np.where(np.linalg.eigvalsh(A)[:, 0] > 0, FIT_OK, FIT_NOT_ELLIPSOID)
+    A[status != FIT_OK] = np.eye(3)
+    U = np.linalg.cholesky(A).transpose(0, 2, 1)
+
+    b = p[:, 6:9]
+    v = np.einsum('ki,kij->kj', b / 2, np.linalg.inv(U.transpose(0, 2, 1)))
+    r = np.sum(v ** 2, axis=1) - p[:, -1]
+    status[r <= 0] = FIT_NOT_ELLIPSOID
+    s = 1 / np.sqrt(np.where(r > 0, r, 1))
+    c = -1 * np.einsum('ki,kij->kj', v, np.linalg.inv(U))
+    U = s[:, None, None] * U
+
+    # Refill the lower triangular part symmetrically
+    U[:, 1, 0] = U[:, 0, 1]
+    U[:, 2, 0] = U[:, 0, 2]
+    U[:, 2, 1] = U[:, 1, 2]
+    return U, c, status
+
+
+class StreamingEllipsoidFit:
+
+    """Ellipsoid fit that is updated batch by batch as samples arrive"""
+
+    def __init__(self):
+
+        """
+        Only the 10x10 R factor of the QR decomposition of the design matrix
+        is kept. Stacking a new batch under it and re-triangularizing gives the
+        R factor of all the data so far, so an update costs O(batch) and a
+        solve is independent of the number of samples.
+        """
+        self.R = np.zeros([0, 10])
+        self.N = 0
+
+    def reset(self):
+        self.R = np.zeros([0, 10])
+        self.N = 0
+
+    def update(self, X):
+        """
+        Fold a batch of samples into the fit
+        :param X: (n, >=3) array, Only the first three columns are used
+        """
+        if len(X) == 0:
+            return
+        D = design_matrix(X)
+        self.R = np.linalg.qr(np.concatenate([self.R, D]), mode='r')
+        self.N += len(X)
+
+    def solve(self):
+        """
+        Current fit, the same as fit_ellipsoid on all the samples so far.
+        Failures are silent because this is polled while collecting data.
+        :return: U and c, or None if there is not enough data yet
+        """
+        if self.N < 10:
+            return None
+        return ellipsoid_parameters(self.R, verbose=False)
+
+    @property
+    def residual(self) -> float:
+        """RMS algebraic residual of the fitted quadric over all samples"""
+        if self.N < 10:
+            return np.nan
+        return np.linalg.svd(self.R, compute_uv=False)[-1] / np.sqrt(self.N)
+
+
+def transform_mag(X, U, c, out=None):
     if len(X.shape) == 0:
         raise ValueError
 
@@ -80,4 +261,87 @@ def transform_mag(X, U, c):
         X = np.expand_dims(X, 0)
 
     # Transform the values and return the new values of the magnetic field vectors
-    return np.dot(X - c, U)
+    if out is None:
+        return np.dot(X - c, U)
+    # out follows the shape of X, a single sample may come with a (3,) out
+    target = out.reshape(X.shape) if out.ndim < 2 else out
+    if target.shape != X.shape:
+        raise ValueError("out has shape %s, %s expected" % (out.shape, X.shape))
+    # The offset goes into a scratch buffer so the product is written straight to out,
+    # as CalibratedStream.apply does, instead of through a temporary and a copy
+    scratch = np.subtract(X, c, dtype=out.dtype)
+    np.matmul(scratch, U, out=target)
+    return out
+
+
+class CalibratedStream:
+
+    """Applies a calibration to long logs or live data chunk by chunk"""
+
+    def __init__(self, U, c, field=None, dtype=np.float64, chunk=65536):
+
+        """
+        U and c are converted to the working precision once. The offset is
+        subtracted into a scratch buffer that is reused between calls, so
+        applying the calibration allocates nothing when out= is given.
+        :param U: (3, 3) array, Calibration matrix scaled to the field strength
+        :param c: (3,) array, Offset vector
+        :param field: float or None, Expected |B|. If given the magnitude error
+        of every sample is computed in the same pass.
+        :param dtype: np.float32 or np.float64, Working and output precision
+        :param chunk: int, Samples processed at once by apply_chunked
+        """
+        self.dtype = np.dtype(dtype)
+        self.U = np.asarray(U, dtype=self.dtype)
+        self.c = np.asarray(c, dtype=self.dtype)
+        self.field = field
+        self.chunk = chunk
+        self.__scratch = np.empty([0, 3], dtype=self.dtype)
+
+    def __scratch_for(self, n):
+        if len(self.__scratch) < n:
+            self.__scratch = np.empty([n, 3], dtype=self.dtype)
+        return self.__scratch[:n]
+
+    def apply(self, X, out=None, error=None):
+        """
+        Calibrate a block of samples
+        :param X: (n, 3) array in any float precision
+        :param out: (n, 3) array or None, Receives the calibrated samples
+        :param error: (n,) array or None, Receives |calibrated| - field
+        :return: the calibrated samples and the magnitude error, None without a field
+        """
+        n = len(X)
+        if out is None:
+            out = np.empty([n, 3], dtype=self.dtype)
+        scratch = self.__scratch_for(n)
+        np.subtract(X, self.c, out=scratch, casting='same_kind')
+        np.matmul(scratch, self.U, out=out)
+        if self.field is None:
+            return out, None
+        if error is None:
+            error = np.empty(n, dtype=self.dtype)
+        # Squared magnitude straight into the error buffer, then the rest in place
+        np.einsum('ni,ni->n', out, out, out=error)
+        np.sqrt(error, out=error)
+        error -= self.field
+        return out, error
+
+    def apply_chunked(self, X, out=None, error=None):
+        """
+        Calibrate a long array, e.g. the memory map of a recording, without
+        holding intermediate copies of it
+        :param X: (N, 3) array or memmap
+        :param out: (N, 3) array, memmap or None
+        :param error: (N,) array or None
+        :return: the calibrated samples and the magnitude error, None without a field
+        """
+        N = len(X)
+        if out is None:
+            out = np.empty([N, 3], dtype=self.dtype)
+        if error is None and self.field is not None:
+            error = np.empty(N, dtype=self.dtype)
+        for i in range(0, N, self.chunk):
+            j = min(i + self.chunk, N)
+            self.apply(X[i:j], out[i:j], None if error is None else error[i:j])
+        return out, error
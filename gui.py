@@ -1,15 +1,29 @@
 import tkinter as tk
-from tkinter import messagebox, filedialog
+from tkinter import messagebox, filedialog, simpledialog
 from os import path
 import serial.tools.list_ports as stl
 from serial import SerialException
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.pyplot as plt
+import importlib
 import json
+import threading
+import time
+from urllib.parse import quote
 from serial_port import SerialPort
+from replay_port import ReplayPort, REPLAY_SCHEME
+from acquisition import AcquisitionThread
+from live_plot import LivePlot
+from recording import open_writer, load_samples
 import numpy as np
-from fit_ellipsoid import fit_ellipsoid, transform_mag
+from fit_ellipsoid import fit_ellipsoid, transform_mag, StreamingEllipsoidFit
+from robust_fit import fit_ellipsoid_robust
+from refine_fit import refine_fit
+from orientation_coverage import CoverageIndex, thin_samples
 from utilities import generate_ellispoid, matrix_string
+from temperature import fit_temperature_compensation, TemperatureModel
+from fit_cache import FitCache, file_signature, user_cache_file
+from instrumentation import Metrics
+from sample_store import SampleStore
+from calibration_store import CalibrationStore, recording_hash, record_to_json
 
 
 class CalibrationTool(tk.Tk):
@@ -91,17 +105,51 @@ class CalibrationTool(tk.Tk):
         self.__geomag_entry__ = tk.Entry(self, textvariable=self.__geomag_entry_v__, width=7)
         self.__geomag_entry__.grid(row=3, column=6, padx=5, pady=5, sticky='w')
 
-        self.fig = plt.figure()
-        self.ax1 = self.fig.add_subplot(121, projection='3d')
-        self.ax1.dist = 8.5
-        self.ax2 = self.fig.add_subplot(122, projection='3d')
-        self.ax1.set_box_aspect((1, 1, 1))
-        self.ax2.set_box_aspect((1, 1, 1))
-        self.ax2.dist = 8.5
-
-        self.__plot_canvas__ = FigureCanvasTkAgg(self.fig, master=self)
-        self.__plot_canvas__.draw()
-        self.__plot_canvas__.get_tk_widget().grid(row=4, column=0, columnspan=5, rowspan=5, sticky='nsew')
+        # Outlier rejection for the calibration
+        self.__robust_v__ = tk.BooleanVar()
+        self.__robust_check__ = tk.Checkbutton(self, text="Reject outliers", variable=self.__robust_v__)
+        self.__robust_check__.grid(row=2, column=5, columnspan=2, padx=5, pady=5, sticky='w')
+
+        # Cap the samples per direction so resting orientations do not dominate the fit
+        self.__thin_v__ = tk.BooleanVar()
+        self.__thin_check__ = tk.Checkbutton(self, text="Balance samples", variable=self.__thin_v__)
+        self.__thin_check__.grid(row=1, column=5, columnspan=2, padx=5, pady=5, sticky='w')
+
+        # Sensor sends the temperature as a fourth value, calibrate over a temperature sweep
+        self.__temp_v__ = tk.BooleanVar()
+        self.__temp_check__ = tk.Checkbutton(self, text="Temperature channel", variable=self.__temp_v__)
+        self.__temp_check__.grid(row=2, column=3, columnspan=2, padx=5, pady=5, sticky='w')
+
+        # Nonlinear refinement of the closed-form fit, also gives the uncertainties
+        self.__refine_v__ = tk.BooleanVar()
+        self.__refine_check__ = tk.Checkbutton(self, text="Refine fit", variable=self.__refine_v__)
+        self.__refine_check__.grid(row=0, column=5, padx=5, pady=5, sticky='w')
+
+        # Timing of the pipeline stages, only collected while the panel is open
+        self.__diag_button__ = tk.Button(self, text="Diagnostics", command=self.__open_diagnostics__)
+        self.__diag_button__.grid(row=0, column=6, padx=5, pady=5, sticky='w')
+        self.__diag_window__ = None
+        self.__diag_text__ = None
+        self.metrics = Metrics()
+
+        # The plots are built once the window is up, matplotlib takes seconds
+        # to import on slow machines. It is imported in the background meanwhile.
+        self.fig = None
+        self.ax1 = None
+        self.ax2 = None
+        self.__plot_canvas__ = None
+        self.__live_plot__ = None
+        self.__calibrated_plot__ = None
+        self.__gap_plot__ = None
+        self.__plot_placeholder__ = tk.Label(self, text="Loading plots...", width=80, height=25)
+        self.__plot_placeholder__.grid(row=4, column=0, columnspan=5, rowspan=5, sticky='nsew')
+        self.__plot_import__ = threading.Thread(target=import_plotting, daemon=True)
+        self.__plot_import__.start()
+
+        # Fitted surfaces, replaced on every calibration. The mesh resolution
+        # is the level of detail, lower keeps rotating the plots responsive.
+        self.__surfaces__ = []
+        self.__mesh_lod__ = 40
 
         # A basic status bar
         self.__status_bar__ = tk.Label(self, text="Ready...", relief=tk.SUNKEN, anchor=tk.W)
@@ -113,6 +161,14 @@ class CalibrationTool(tk.Tk):
 
         self.U = np.zeros([3, 3])
         self.c = np.zeros(3)
+        self.temperature_model = None
+        # Method, sample counts and residuals of the last calibration, for the database
+        self.__fit_info__ = None
+        self.__uncertainty__ = None
+
+        # Fits of earlier recordings, kept between runs in the user cache folder, and the last recording read
+        self.__fit_cache__ = FitCache(filename=user_cache_file('fit_cache.json'))
+        self.__loaded__ = None
 
         self.__label_U__ = tk.Label(self, text="Soft-iron \ncalibration matrix:", justify='left')
         self.__label_U__.grid(row=5, column=5, columnspan=2, padx=5, pady=5, sticky='sw')
@@ -151,6 +207,26 @@ class CalibrationTool(tk.Tk):
 
         self.ser = None
         self.file = None
+        self.acq = None
+
+        # Interval at which the acquisition ring buffer is drained
+        self.__poll_ms__ = 50
+        self.__last_poll__ = None
+
+        # Fit of the current session, updated with every drained batch
+        self.__stream_fit__ = StreamingEllipsoidFit()
+        self.__fit_spread__ = np.nan
+
+        # Directions the sensor has been pointed in during the session
+        self.__coverage__ = CoverageIndex()
+        # Number of empty directions the gap markers were last drawn for
+        self.__gaps_shown__ = -1
+
+        # Samples of the recording in memory, so calibrating does not read the
+        # file again. Beyond the budget the time resolution is halved. Only used
+        # while it holds everything in the file, i.e. the file was started here.
+        self.__session__ = SampleStore(3, max_samples=1000000)
+        self.__session_file__ = None
 
         # File number and line counts
         # Defaults. These are changed if a cache is found
@@ -167,6 +243,40 @@ class CalibrationTool(tk.Tk):
         self.__set_fields__()
         self.__sweep_port__()
 
+    def __build_plots__(self):
+        # Blocks until the background import is done if it is still running
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        import matplotlib.pyplot as plt
+
+        self.fig = plt.figure()
+        self.ax1 = self.fig.add_subplot(121, projection='3d')
+        self.ax1.dist = 8.5
+        self.ax2 = self.fig.add_subplot(122, projection='3d')
+        self.ax1.set_box_aspect((1, 1, 1))
+        self.ax2.set_box_aspect((1, 1, 1))
+        self.ax2.dist = 8.5
+
+        self.__plot_placeholder__.destroy()
+        self.__plot_canvas__ = FigureCanvasTkAgg(self.fig, master=self)
+        self.__plot_canvas__.get_tk_widget().grid(row=4, column=0, columnspan=5, rowspan=5, sticky='nsew')
+        self.__plot_canvas__.draw_idle()
+
+        # Single artist holding the raw samples, updated in place while logging
+        self.__live_plot__ = LivePlot(self.ax1, self.__plot_canvas__, c='r')
+        self.__calibrated_plot__ = LivePlot(self.ax2, self.__plot_canvas__, c='xkcd:sky blue', alpha=0.6)
+        # Directions not covered yet, on the sphere around the raw samples
+        self.__gap_plot__ = LivePlot(self.ax1, self.__plot_canvas__, autoscale=False, c='k', marker='x')
+        # Samples that arrived before the plots existed
+        if len(self.__session__) > 0:
+            self.__live_plot__.set_data(self.__session__.samples)
+            self.__show_gaps__()
+
+    def __wait_for_plots__(self):
+        if self.__plot_import__.is_alive():
+            self.after(self.__poll_ms__, self.__wait_for_plots__)
+        elif self.fig is None:
+            self.__build_plots__()
+
     def __start_serial_logging__(self):
         self.folder = self.__folder_entry_v__.get()
 
@@ -185,9 +295,21 @@ class CalibrationTool(tk.Tk):
 
         self.delimiter = self.__delim_entry_v__.get()
         self.field = self.__geomag_entry_v__.get()
+        nchannels = 4 if self.__temp_v__.get() else 3
 
+        filepath = path.join(self.folder, self.filename)
         try:
-            self.ser = SerialPort(self.com_port, self.folder, baudrate=self.baudrate, delimiter=self.delimiter)
+            if self.com_port.startswith(REPLAY_SCHEME):
+                # A recording played back through the same path as a device
+                self.ser = ReplayPort.from_url(self.com_port, self.folder, baudrate=self.baudrate,
+                                               nchannels=nchannels, delimiter=self.delimiter, metrics=self.metrics)
+                if path.realpath(self.ser.port) == path.realpath(filepath):
+                    messagebox.showerror("Error!", message="Choose another filename than the replayed recording!")
+                    self.start_logging = False
+                    return
+            else:
+                self.ser = SerialPort(self.com_port, self.folder, baudrate=self.baudrate, nchannels=nchannels,
+                                      delimiter=self.delimiter, metrics=self.metrics)
             self.ser.open_port()
         except SerialException:
             messagebox.showerror("Error!",
@@ -195,7 +317,18 @@ class CalibrationTool(tk.Tk):
             self.start_logging = False
             return
 
-        self.file = open(path.join(self.folder, self.filename), 'a')
+        if filepath != self.__session_file__ or self.__session__.nchannels != nchannels:
+            self.__session__ = SampleStore(nchannels, max_samples=1000000)
+            new_file = not path.isfile(filepath) or path.getsize(filepath) == 0
+            self.__session_file__ = filepath if new_file else None
+        self.file = open_writer(filepath, self.delimiter, nchannels)
+
+        self.acq = AcquisitionThread(self.ser)
+        self.acq.start()
+        self.__stream_fit__.reset()
+        self.__fit_spread__ = np.nan
+        self.__coverage__.reset()
+        self.__gaps_shown__ = -1
 
         self.start_logging = True
         self.__status_bar__.config(text='Logging...')
@@ -204,12 +337,113 @@ class CalibrationTool(tk.Tk):
         self.start_logging = False
         self.__status_bar__.config(text='Ready...')
 
+        if self.acq is not None:
+            self.acq.stop()
+            # Keep whatever was still queued when the reader stopped
+            self.__consume_samples__(self.acq.ring.drain())
+            self.acq = None
+        if self.__live_plot__ is not None:
+            self.__live_plot__.refresh(force=True)
         if self.file is not None:
             self.file.close()
             self.file = None
-        if self.ser.isOpen():
+        if self.ser is not None and self.ser.isOpen():
             self.ser.close()
 
+    def __consume_samples__(self, data):
+        if len(data) == 0:
+            return
+        metrics = self.metrics
+        if self.__live_plot__ is not None:
+            with metrics.stage("plot"):
+                self.__live_plot__.append(data)
+        with metrics.stage("fit"):
+            self.__stream_fit__.update(data)
+            params = self.__stream_fit__.solve()
+            if params is not None:
+                # Spread of the calibrated magnitudes of the newest samples, 0 for a perfect fit
+                U, c = params
+                self.__fit_spread__ = np.std(np.linalg.norm(transform_mag(data[:, :3], U, c), axis=1))
+        with metrics.stage("coverage"):
+            self.__coverage__.update(data)
+            self.__show_gaps__()
+        if self.file is not None:
+            with metrics.stage("save"):
+                self.file.append(data)
+            self.__session__.append(data, time.time())
+        metrics.count("samples", len(data))
+
+    def __show_gaps__(self):
+        # Cells only fill up, so the markers are redrawn when one more direction is covered
+        coverage = self.__coverage__
+        if self.__gap_plot__ is None or coverage.center is None:
+            return
+        empty = coverage.empty_directions()
+        if len(empty) == self.__gaps_shown__:
+            return
+        radius = np.mean(coverage.hi - coverage.lo) / 2
+        self.__gap_plot__.set_data(coverage.center + radius * empty)
+        self.__gaps_shown__ = len(empty)
+
+    def __poll_acquisition__(self):
+        now = time.monotonic()
+        if self.__last_poll__ is not None:
+            # Delay of the timer beyond the poll interval, i.e. time the event
+            # loop spent elsewhere, mostly redrawing the canvas
+            self.metrics.record("loop lag", max(0.0, now - self.__last_poll__ - self.__poll_ms__ / 1000))
+        self.__last_poll__ = now
+        if self.start_logging and self.acq is not None:
+            self.__consume_samples__(self.acq.ring.drain())
+            # Draw points held back by the frame rate cap
+            if self.__live_plot__ is not None:
+                with self.metrics.stage("plot"):
+                    self.__live_plot__.refresh()
+            status = 'Logging... %d lines, %d dropped, %d overruns' \
+                     % (self.ser.total_lines, self.acq.dropped, self.acq.overruns)
+            if not np.isnan(self.__fit_spread__):
+                status += ', fit spread %.1f%%' % (100 * self.__fit_spread__)
+            status += ', coverage %.0f%%' % (100 * self.__coverage__.coverage)
+            missing = self.__coverage__.missing_axes()
+            if len(missing) > 0:
+                status += ', missing ' + ' '.join(missing)
+            self.__status_bar__.config(text=status)
+            if not self.acq.is_alive():
+                # Reader stopped on its own, e.g. the device was unplugged or the replay ended
+                replay = isinstance(self.ser, ReplayPort)
+                self.__stop_serial_logging__()
+                self.__status_bar__.config(text='Replay finished...' if replay else 'Serial port lost...')
+        if self.__diag_window__ is not None:
+            self.__diag_text__.config(text=self.metrics.summary())
+        self.after(self.__poll_ms__, self.__poll_acquisition__)
+
+    def __open_diagnostics__(self):
+        if self.__diag_window__ is not None:
+            self.__diag_window__.lift()
+            return
+        self.metrics.reset()
+        self.metrics.enabled = True
+        self.__diag_window__ = tk.Toplevel(self)
+        self.__diag_window__.title("Diagnostics")
+        self.__diag_window__.protocol("WM_DELETE_WINDOW", self.__close_diagnostics__)
+        self.__diag_text__ = tk.Label(self.__diag_window__, text="", font="TkFixedFont", justify='left', anchor='nw')
+        self.__diag_text__.grid(row=0, column=0, columnspan=2, padx=5, pady=5, sticky='nsew')
+        tk.Button(self.__diag_window__, text="Reset", width=10,
+                  command=self.metrics.reset).grid(row=1, column=0, padx=5, pady=5, sticky='w')
+        tk.Button(self.__diag_window__, text="Save...", width=10,
+                  command=self.__dump_diagnostics__).grid(row=1, column=1, padx=5, pady=5, sticky='e')
+
+    def __close_diagnostics__(self):
+        self.metrics.enabled = False
+        self.__diag_window__.destroy()
+        self.__diag_window__ = None
+        self.__diag_text__ = None
+
+    def __dump_diagnostics__(self):
+        fname = filedialog.asksaveasfilename(initialdir=self.folder, initialfile="metrics.json",
+                                             defaultextension=".json")
+        if len(fname) != 0:
+            self.metrics.dump(fname)
+
     def __compute_coefficients__(self):
         # Check if port has been closed
         if self.ser is not None:
@@ -217,40 +451,155 @@ class CalibrationTool(tk.Tk):
                 messagebox.showerror("Error!",
                                      message="Please close serial port before performing computation!")
                 return
+        filepath = path.join(self.folder, self.filename)
+        from_session = filepath == self.__session_file__ and len(self.__session__) > 0
         try:
             self.delimiter = self.__delim_entry_v__.get()
-            data = np.loadtxt(path.join(self.folder, self.filename), delimiter=self.delimiter)
+            signature = file_signature(filepath)
+            if from_session:
+                data = self.__session__.samples
+            elif self.__loaded__ is not None and self.__loaded__[0] == (filepath, signature):
+                # Same recording as last time, e.g. only the field changed
+                data = self.__loaded__[1]
+            else:
+                data = load_samples(filepath, delimiter=self.delimiter)
+                self.__loaded__ = ((filepath, signature), data)
         except FileNotFoundError:
             messagebox.showerror("Error!", message="No datafile found at location! Try collecting again")
             return
-        params = fit_ellipsoid(data)
+        method = "temperature" if self.__temp_v__.get() else "robust" if self.__robust_v__.get() else "fit"
+        if method == "temperature" and data.shape[1] < 4:
+            messagebox.showerror("Error!", message="The recording holds no temperature values!")
+            return
+
+        t0 = time.perf_counter()
+        options = {"method": method, "thin": self.__thin_v__.get(), "robust": self.__robust_v__.get(),
+                   "refine": self.__refine_v__.get() and method != "temperature",
+                   "delimiter": self.delimiter, "decimation": self.__session__.stride if from_session else 1}
+        if method == "fit" and not options["thin"] and not options["refine"] and options["decimation"] == 1:
+            # Also reuses the fit of the recording before more samples were appended
+            params = self.__fit_cache__.fit(filepath, self.delimiter, data)
+            extra = {"outliers": 0}
+        else:
+            cached = self.__fit_cache__.get(filepath, options, signature)
+            if cached is not None:
+                params, extra = cached[:2], cached[2]
+            else:
+                params, extra = self.__fit_samples__(data, method, options["thin"], options["refine"])
+                if params is not None:
+                    self.__fit_cache__.put(filepath, options, *params, extra=extra, signature=signature)
+        self.metrics.record("calibrate", time.perf_counter() - t0)
         if params is not None:
+            if "status" in extra:
+                self.__status_bar__.config(text=extra["status"])
+            if self.fig is None:
+                self.__build_plots__()
             self.field = float(self.__geomag_entry_v__.get())
             self.U, self.c = params
-            self.U *= self.field
+            self.U = self.U * self.field
+            self.temperature_model = None
+            self.__uncertainty__ = None
+            if "uncertainty" in extra:
+                # U and its errors scale with the field, c does not
+                self.__uncertainty__ = {"U_std": (self.field * np.array(extra["uncertainty"]["U_std"])).tolist(),
+                                        "c_std": extra["uncertainty"]["c_std"]}
+            if method == "temperature":
+                self.temperature_model = TemperatureModel.from_dict(extra["temperature"]).scaled(self.field)
             self.__results_U__.config(text=matrix_string(self.U))
             self.__results_c__.config(text=matrix_string(self.c))
 
             # Results are also plotting
-            x1, y1, z1, x2, y2, z2 = generate_ellispoid(self.U, self.c, self.field)
+            x1, y1, z1, x2, y2, z2 = generate_ellispoid(self.U, self.c, self.field, self.__mesh_lod__)
             if self.ser is None:
-                self.ax1.scatter3D(data[:, 0], data[:, 1], data[:, 2], c='r', alpha=0.6)
-            self.ax1.plot_surface(x2, y2, z2, color='r', alpha=0.5, antialiased=True)
-            data_tx = transform_mag(data, self.U, self.c)
-            self.ax2.scatter3D(data_tx[:, 0], data_tx[:, 1], data_tx[:, 2], c='xkcd:sky blue', alpha=0.6)
-            self.ax2.plot_surface(x1, y1, z1, color='xkcd:sky blue', alpha=0.5, antialiased=True)
+                self.__live_plot__.set_data(data)
+            for surface in self.__surfaces__:
+                surface.remove()
+            self.__surfaces__ = [
+                self.ax1.plot_surface(x2, y2, z2, color='r', alpha=0.5, antialiased=True),
+                self.ax2.plot_surface(x1, y1, z1, color='xkcd:sky blue', alpha=0.5, antialiased=True)]
+            if self.temperature_model is not None:
+                data_tx = self.temperature_model.apply(data, data[:, 3])
+            else:
+                data_tx = transform_mag(data[:, :3], self.U, self.c)
+            self.__calibrated_plot__.set_data(data_tx)
+
+            residual = np.linalg.norm(data_tx, axis=1) - self.field
+            self.__fit_info__ = {
+                "method": method + ("+refine" if "uncertainty" in extra else ""), "samples": len(data),
+                "outliers": extra["outliers"], "recording": filepath,
+                "rms_residual": float(np.sqrt(np.mean(residual ** 2))),
+                "max_residual": float(np.abs(residual).max())}
         else:
             messagebox.showerror("Error!",
                                  message="Not enough data to perform calibration!")
 
+    def __fit_samples__(self, data, method, thin, refine=False):
+        """
+        :return: U and c for a field of 1, or None, and a dict with the number
+        of outliers, the status text, the temperature model and with refine the
+        standard errors of U and c
+        """
+        fit_data = thin_samples(data) if thin else data
+        extra = {"outliers": 0}
+        if method == "temperature":
+            model, table, inliers = fit_temperature_compensation(fit_data, fit_data[:, 3],
+                                                                 reject=0.05 if self.__robust_v__.get() else None)
+            if model is None:
+                return None, extra
+            extra["outliers"] = int(np.count_nonzero(~inliers))
+            extra["temperature"] = model.to_dict()
+            extra["status"] = '%d temperature bins, %.1f to %.1f degrees' % (len(table['T']), *model.t_range)
+            # Shown and plotted at the mean temperature
+            return model.evaluate(model.t0), extra
+        if method == "robust":
+            result = fit_ellipsoid_robust(fit_data)
+            if result is None:
+                return None, extra
+            stats = result[3]
+            extra["outliers"] = stats['outliers']
+            extra["status"] = '%d outliers rejected, rms error %.2f%%' % (stats['outliers'], 100 * stats['rms'])
+            params, inliers = result[:2], result[2]
+        else:
+            params, inliers = fit_ellipsoid(fit_data), np.ones(len(fit_data), dtype=bool)
+        if not refine or params is None:
+            return params, extra
+        refined = refine_fit(fit_data[inliers], *params)
+        if refined is None:
+            return params, extra
+        U, c, info = refined
+        extra["uncertainty"] = {"U_std": info["U_std"].tolist(), "c_std": info["c_std"].tolist()}
+        extra["status"] = '%srefined in %d iterations, rms error %.2f%%, c +- %s' % (
+            '%d outliers rejected, ' % extra["outliers"] if method == "robust" else '', info["iterations"],
+            100 * info["rms"], np.array2string(info["c_std"], precision=3))
+        return (U, c), extra
+
     def __save_coefficients__(self):
-        data_dict = {"U": np.array2string(self.U, separator=",", formatter={'float_kind': lambda x: "%.4f" % x}),
-                     "c": np.array2string(self.c, separator=",", formatter={'float_kind': lambda x: "%.4f" % x}),
-                     "B": str(self.field)}
-        dict_str = json.dumps(data_dict, indent=4)
-        with open("parameters.json", "w") as f:
-            f.write(dict_str)
-            f.close()
+        if self.__fit_info__ is None:
+            messagebox.showerror("Error!", message="Nothing to save, calibrate first!")
+            return
+        device = simpledialog.askstring("Save", "Device serial:", parent=self,
+                                        initialvalue=path.splitext(self.filename)[0])
+        if not device:
+            return
+        info = self.__fit_info__
+        try:
+            digest = recording_hash(info["recording"])
+        except OSError:
+            digest = None
+        extra = {}
+        if self.temperature_model is not None:
+            extra["temperature"] = self.temperature_model.to_dict()
+        if self.__uncertainty__ is not None:
+            extra["uncertainty"] = self.__uncertainty__
+
+        # Every calibration is kept in the database next to the recordings, the
+        # parameter file only holds the latest one of the device
+        with CalibrationStore(path.join(self.folder, "calibrations.sqlite")) as store:
+            store.add(device, self.U, self.c, field=self.field, recording_hash=digest, extra=extra or None, **info)
+            record = store.latest(device)
+        with open(path.join(self.folder, device + ".json"), "w") as f:
+            json.dump(record_to_json(record), f, indent=4)
+        self.__status_bar__.config(text='Saved calibration of %s' % device)
 
     def __set_fields__(self):
         # Load the cached values
@@ -265,6 +614,10 @@ class CalibrationTool(tk.Tk):
             self.__folder_entry_v__.set(var_dict['folder'])
             self.__delim_entry_v__.set(var_dict['delimiter'])
             self.__geomag_entry_v__.set(str(var_dict['field']))
+            self.__robust_v__.set(var_dict.get('robust', False))
+            self.__thin_v__.set(var_dict.get('thin', False))
+            self.__temp_v__.set(var_dict.get('temperature', False))
+            self.__refine_v__.set(var_dict.get('refine', False))
         else:
             self.__filen_entry_v__.set(self.__def_filename)
             self.__com_port_v__.set(self.__def_com)
@@ -280,6 +633,18 @@ class CalibrationTool(tk.Tk):
         for port in port_list:
             self.__com_menu__['menu'].add_command(label=port.description,
                                                   command=tk._setit(self.__com_port_v__, port.device))
+        self.__com_menu__['menu'].add_command(label="Replay recording...", command=self.__choose_replay__)
+
+    def __choose_replay__(self):
+
+        fname = filedialog.askopenfilename(initialdir=self.folder)
+        if len(fname) == 0:
+            return
+        speed = simpledialog.askfloat("Replay", "Speed, 0 for as fast as possible:", parent=self,
+                                      initialvalue=1.0, minvalue=0.0)
+        if speed is None:
+            return
+        self.__com_port_v__.set("%s%s?speed=%g" % (REPLAY_SCHEME, quote(fname), speed))
 
     def __set_folder__(self):
 
@@ -295,7 +660,11 @@ class CalibrationTool(tk.Tk):
             'com_port': self.__com_port_v__.get(),
             'filename': self.__filen_entry_v__.get(),
             'delimiter': self.__delim_entry_v__.get(),
-            'field': self.__geomag_entry_v__.get()
+            'field': self.__geomag_entry_v__.get(),
+            'robust': self.__robust_v__.get(),
+            'thin': self.__thin_v__.get(),
+            'temperature': self.__temp_v__.get(),
+            'refine': self.__refine_v__.get()
         }
         dict_str = json.dumps(var_dict, indent=4)
         with open(self.__cache_file__, 'w') as f:
@@ -305,24 +674,26 @@ class CalibrationTool(tk.Tk):
     def close(self):
         yn = tk.messagebox.askyesno(title="Quit", message="Do you want to quit?")
         if yn:
+            if self.acq is not None:
+                self.acq.stop()
             if self.ser is not None:
                 self.ser.close()
             if self.file is not None:
                 self.file.close()
             self.__dump_cache__()
+            self.__fit_cache__.save()
             self.quit()
             self.destroy()
 
     def run(self):
-        while 1:
-            if self.start_logging:
-                self.ser.fill_buffer()
-                self.ax1.scatter(self.ser.data_buffer[:, 0], self.ser.data_buffer[:, 1],
-                                self.ser.data_buffer[:, 2], c='r')
-                self.__plot_canvas__.draw()
-                np.savetxt(self.file, self.ser.data_buffer, delimiter=self.delimiter)
-            try:
-                self.update()
-            except tk.TclError:
-                break
+        self.after(self.__poll_ms__, self.__poll_acquisition__)
+        self.after(self.__poll_ms__, self.__wait_for_plots__)
+        self.mainloop()
+
 
+def import_plotting():
+    """Load the plotting modules, meant to run in a background thread"""
+    # Imported for their side effect of filling the module cache, so
+    # __build_plots__ finds them loaded
+    for module in ("matplotlib.pyplot", "mpl_toolkits.mplot3d", "matplotlib.backends.backend_tkagg"):
+        importlib.import_module(module)
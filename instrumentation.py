@@ -0,0 +1,191 @@
+# Lightweight timing and counters for the acquisition and fit pipeline.
+# Latencies go into fixed histograms with logarithmic buckets, so recording a
+# value is a bisect and an increment and the memory does not grow with the
+# session. A disabled Metrics object hands out a shared no-op context and
+# ignores counts, so the instrumented code paths cost next to nothing.
+
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+import numpy as np
+
+# Bucket upper bounds in seconds, 1 us to 10 s with 10 buckets per decade
+BUCKET_EDGES = tuple(10.0 ** (e / 10) for e in range(-60, 11))
+
+NULL_CONTEXT = nullcontext()
+
+
+class LatencyHistogram:
+
+    """Counts of latencies in logarithmic buckets"""
+
+    def __init__(self, edges=BUCKET_EDGES):
+
+        """
+        :param edges: sorted tuple of bucket upper bounds in seconds, anything
+        above the last one is counted in an extra overflow bucket
+        """
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(self.edges, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q) -> float:
+        """
+        Upper bound of the bucket holding the q-th percentile
+        :param q: float, Percentile between 0 and 100
+        :return: float, Seconds, nan without any values
+        """
+        if self.total == 0:
+            return np.nan
+        rank = np.searchsorted(np.cumsum(self.counts), q / 100 * self.total)
+        return min(self.edges[rank], self.max) if rank < len(self.edges) else self.max
+
+    def summary(self) -> dict:
+        return {"count": self.total, "mean": self.sum / self.total if self.total else np.nan,
+                "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99),
+                "max": self.max}
+
+
+class StageTimer:
+
+    """Context manager recording its duration in a histogram"""
+
+    __slots__ = ("histogram", "t0")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.t0 = 0.0
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.record(time.perf_counter() - self.t0)
+        return False
+
+
+class Metrics:
+
+    """Per stage latency histograms, event counters and gauges"""
+
+    def __init__(self, enabled=False):
+
+        """
+        A stage, counter or gauge should only be written from one thread,
+        e.g. "read" and "parse" from the reader thread and "plot" from the
+        GUI. Reading them from another thread for display is fine.
+        :param enabled: bool, Collect anything at all
+        """
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.start_time = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reset(self):
+        with self.__lock:
+            self.stages = {}
+            self.counters = {}
+            self.gauges = {}
+        self.start_time = time.monotonic()
+
+    def __histogram(self, name):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            with self.__lock:
+                histogram = self.stages.setdefault(name, LatencyHistogram())
+        return histogram
+
+    def stage(self, name):
+        """
+        Time the enclosed block as one occurrence of a stage
+            with metrics.stage("parse"):
+                ...
+        :param name: string, Stage name
+        """
+        if not self.enabled:
+            return NULL_CONTEXT
+        return StageTimer(self.__histogram(name))
+
+    def record(self, name, seconds):
+        """
+        Add a latency measured elsewhere
+        :param name: string, Stage name
+        :param seconds: float
+        """
+        if self.enabled:
+            self.__histogram(name).record(seconds)
+
+    def count(self, name, n=1):
+        """
+        :param name: string, Counter name
+        :param n: int, Increment
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        """
+        Current value of a level such as the queue depth, the maximum is kept too
+        :param name: string, Gauge name
+        :param value: float
+        """
+        if self.enabled:
+            _, peak = self.gauges.get(name, (value, value))
+            self.gauges[name] = (value, max(peak, value))
+
+    def snapshot(self) -> dict:
+        """
+        Machine readable state, counters come with their rates per second
+        since the start or the last reset
+        :return: dict
+        """
+        elapsed = time.monotonic() - self.start_time
+        with self.__lock:
+            stages = dict(self.stages)
+        return {"elapsed": elapsed,
+                "stages": {name: h.summary() for name, h in stages.items()},
+                "counters": {name: {"total": n, "rate": n / elapsed if elapsed > 0 else 0.0}
+                             for name, n in list(self.counters.items())},
+                "gauges": {name: {"value": v, "max": peak} for name, (v, peak) in list(self.gauges.items())}}
+
+    def summary(self) -> str:
+        """
+        Human readable table for a status panel
+        :return: string
+        """
+        snap = self.snapshot()
+        lines = ["%-12s %8s %9s %9s %9s" % ("stage", "count", "p50 ms", "p95 ms", "max ms")]
+        for name, s in sorted(snap["stages"].items()):
+            lines.append("%-12s %8d %9.3f %9.3f %9.3f"
+                         % (name, s["count"], 1e3 * s["p50"], 1e3 * s["p95"], 1e3 * s["max"]))
+        for name, c in sorted(snap["counters"].items()):
+            lines.append("%-12s %8d %9.1f/s" % (name, c["total"], c["rate"]))
+        for name, g in sorted(snap["gauges"].items()):
+            lines.append("%-12s %8g max %g" % (name, g["value"], g["max"]))
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        """
+        Write the snapshot as JSON
+        :param filename: string
+        """
+        with open(filename, "w") as f:
+            json.dump(self.snapshot(), f, indent=4, default=float)
+
+
+if __name__ == "__main__":
+    print("Timing and counters of the acquisition pipeline")
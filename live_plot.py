@@ -0,0 +1,111 @@
+import time
+import numpy as np
+from sample_store import SampleStore
+
+
+class LivePlot:
+
+    """Single scatter artist on a 3D axis that is updated in place"""
+
+    def __init__(self, ax, canvas, max_points=5000, max_fps=10.0, capacity=4096, max_samples=None,
+                 autoscale=True, **scatter_kwargs):
+
+        """
+        :param ax: Axes3D, Axis to draw the points on
+        :param canvas: FigureCanvas that owns the axis
+        :param max_points: int, Number of displayed points above which the cloud is downsampled
+        :param max_fps: float, Upper bound on the redraw rate of the canvas
+        :param capacity: int, Initial size of the sample store, doubled when full
+        :param max_samples: int or None, Samples kept for drawing, 4 * max_points by
+        default. Beyond that the store is decimated in time, which only thins
+        what would be strided away for display anyway.
+        :param autoscale: bool, Fit the axis limits to the points, off for an
+        overlay on an axis another LivePlot scales
+        :param scatter_kwargs: Passed on to ax.scatter when the artist is created
+        """
+        self.ax = ax
+        self.canvas = canvas
+        self.max_points = max_points
+        self.min_interval = 1.0 / max_fps
+        self.autoscale = autoscale
+        self.scatter_kwargs = scatter_kwargs
+
+        if max_samples is None:
+            max_samples = 4 * max_points
+        self.store = SampleStore(3, capacity, max_samples=max_samples, mode="decimate")
+
+        self.artist = None
+        self.__last_draw = 0.0
+        self.__dirty = False
+
+    def __len__(self):
+        return len(self.store)
+
+    def append(self, data):
+        """
+        Add samples to the point cloud. The canvas is redrawn only if the
+        last redraw is older than the frame interval.
+        :param data: (n, >=3) array, Only the first three columns are plotted
+        """
+        if len(data) == 0:
+            return
+        self.store.append(data)
+        self.__dirty = True
+        self.refresh()
+
+    def set_data(self, data):
+        """
+        Replace the point cloud and redraw immediately
+        :param data: (n, >=3) array
+        """
+        self.store.clear()
+        self.append(data)
+        self.refresh(force=True)
+
+    def clear(self):
+        """Remove all points from the plot"""
+        self.store.clear()
+        self.__dirty = True
+        self.refresh(force=True)
+
+    def visible_points(self) -> np.ndarray:
+        """
+        Points handed to the artist. Above max_points a constant stride is
+        used so the draw cost does not grow with the session length.
+        :return: (m, 3) array with m <= max_points
+        """
+        points = self.store.samples
+        if len(points) > self.max_points:
+            stride = int(np.ceil(len(points) / self.max_points))
+            points = points[::stride]
+        return points
+
+    def refresh(self, force=False):
+        """
+        Push pending points to the artist and redraw the canvas
+        :param force: bool, Redraw even within the frame interval
+        """
+        if not self.__dirty:
+            return
+        now = time.monotonic()
+        if not force and now - self.__last_draw < self.min_interval:
+            return
+        points = self.visible_points()
+        if self.artist is None:
+            self.artist = self.ax.scatter(points[:, 0], points[:, 1], points[:, 2], **self.scatter_kwargs)
+        else:
+            self.artist._offsets3d = (points[:, 0], points[:, 1], points[:, 2])
+        if self.autoscale and len(points) > 0:
+            # Keep the view around the whole cloud, the artist does not rescale it
+            lo = points.min(axis=0)
+            hi = points.max(axis=0)
+            self.ax.set_xlim(lo[0], hi[0])
+            self.ax.set_ylim(lo[1], hi[1])
+            self.ax.set_zlim(lo[2], hi[2])
+        self.canvas.draw_idle()
+        self.__last_draw = now
+        self.__dirty = False
+
+
+if __name__ == "__main__":
+    print("Incrementally updated scatter plot for the live data")
@@ -0,0 +1,164 @@
+import argparse
+import time
+from os import path
+import numpy as np
+from serial import SerialException
+from serial_port import SerialPort
+from acquisition import AcquisitionThread
+from recording import RecordingWriter
+from fit_ellipsoid import StreamingEllipsoidFit
+
+
+def port_label(port) -> str:
+    """
+    File system friendly name of a serial port, e.g. ttyUSB0 for /dev/ttyUSB0
+    :param port: string
+    """
+    return path.basename(port.rstrip("/\\")).replace(":", "_")
+
+
+class AcquisitionManager:
+
+    """Records several serial ports at once, one reader thread per port"""
+
+    def __init__(self, ports, foldername, baudrate=115200, nchannels=3, delimiter=",", protocol="ascii"):
+
+        """
+        Every port gets its own ring buffer, recording and streaming fit. All
+        readers share one time base so the recordings can be lined up.
+        :param ports: list of strings, Serial port names
+        :param foldername: string, Folder for the recordings, one <port>.mrec per port
+        :param baudrate: int, Baud rate of all ports
+        :param nchannels: int, Number of values per sample
+        :param delimiter: string, Delimiter of text lines
+        :param protocol: string, "ascii" or "binary", see SerialPort
+        """
+        self.ports = list(ports)
+        self.foldername = foldername
+        self.baudrate = baudrate
+        self.nchannels = nchannels
+        self.delimiter = delimiter
+        self.protocol = protocol
+
+        self.serial_ports = {}
+        self.readers = {}
+        self.writers = {}
+        self.fits = {}
+        self.samples = {}
+        # Ports that could not be opened or recorded
+        self.failed = []
+
+        self.time_base = None
+        self.start_time = None
+
+    def start(self):
+        """Open all ports and start their readers"""
+        self.time_base = time.monotonic()
+        self.start_time = time.time()
+        for port in self.ports:
+            sp = SerialPort(port, self.foldername, baudrate=self.baudrate, nchannels=self.nchannels,
+                            delimiter=self.delimiter, protocol=self.protocol)
+            try:
+                sp.open_port()
+            except SerialException:
+                self.failed.append(port)
+                continue
+            try:
+                writer = RecordingWriter(path.join(self.foldername, port_label(port) + ".mrec"), self.nchannels)
+            except (OSError, ValueError) as e:
+                # No reader is started for a port that cannot be recorded
+                print("Recording of port %s cannot be opened: %s" % (port, e))
+                sp.close()
+                self.failed.append(port)
+                continue
+            self.serial_ports[port] = sp
+            self.writers[port] = writer
+            self.fits[port] = StreamingEllipsoidFit()
+            self.samples[port] = 0
+            self.readers[port] = AcquisitionThread(sp, time_base=self.time_base)
+            self.readers[port].start()
+
+    def poll(self) -> dict:
+        """
+        Move the buffered samples of every port into its recording and fit
+        :return: dict of port name to the number of new samples
+        """
+        counts = {}
+        for port, reader in self.readers.items():
+            data = reader.ring.drain()
+            if len(data) > 0:
+                self.writers[port].append(data[:, 1:], self.start_time + data[:, 0])
+                self.fits[port].update(data[:, 1:])
+                self.samples[port] += len(data)
+            counts[port] = len(data)
+        return counts
+
+    def stop(self):
+        """Stop the readers, store what is left and close everything"""
+        for reader in self.readers.values():
+            reader.stop()
+        self.poll()
+        for port in self.readers:
+            self.writers[port].close()
+            if self.serial_ports[port].isOpen():
+                self.serial_ports[port].close()
+
+    def status(self) -> dict:
+        """
+        :return: dict of port name to a dict of sample, line, drop and overrun counts
+        """
+        return {port: {"samples": self.samples[port], "lines": self.serial_ports[port].total_lines,
+                       "dropped": reader.dropped, "overruns": reader.overruns, "alive": reader.is_alive()}
+                for port, reader in self.readers.items()}
+
+    def calibrations(self, field=1.0) -> dict:
+        """
+        :param field: float, Magnitude of the magnetic field, U is scaled to it
+        :return: dict of port name to U and c, or None where there is no fit yet
+        """
+        calibrations = {}
+        for port, fit in self.fits.items():
+            params = fit.solve()
+            calibrations[port] = None if params is None else (params[0] * field, params[1])
+        return calibrations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and calibrate several magnetometers at once")
+    parser.add_argument("ports", nargs="+", help="Serial ports, one per sensor")
+    parser.add_argument("-o", "--output", default=".", help="Folder for the recordings")
+    parser.add_argument("-b", "--baudrate", type=int, default=115200, help="Baud rate of all ports")
+    parser.add_argument("-d", "--delimiter", default=",", help="Delimiter in the serial data")
+    parser.add_argument("-B", "--field", type=float, default=50.0, help="Expected magnetic field magnitude")
+    parser.add_argument("-t", "--duration", type=float, default=60.0, help="Seconds to record")
+    parser.add_argument("--binary", action="store_true", help="Sensors send binary frames")
+    args = parser.parse_args()
+
+    manager = AcquisitionManager(args.ports, args.output, args.baudrate, delimiter=args.delimiter,
+                                 protocol="binary" if args.binary else "ascii")
+    manager.start()
+    for port in manager.failed:
+        print("Could not open or record %s" % port)
+    end = time.monotonic() + args.duration
+    try:
+        while time.monotonic() < end and len(manager.readers) > 0:
+            time.sleep(0.1)
+            manager.poll()
+    except KeyboardInterrupt:
+        pass
+    manager.stop()
+
+    status = manager.status()
+    for port, params in manager.calibrations(args.field).items():
+        s = status[port]
+        print("%s: %d samples, %d dropped, %d overruns" % (port, s["samples"], s["dropped"], s["overruns"]))
+        if params is None:
+            print("    not enough data to calibrate")
+            continue
+        U, c = params
+        print("    U =", np.array2string(U, precision=6).replace("\n", "\n        "))
+        print("    c =", np.array2string(c, precision=6))
+
+
+if __name__ == "__main__":
+    main()
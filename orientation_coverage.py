@@ -0,0 +1,184 @@
+# Coverage of the sensor orientations and balanced thinning of the samples.
+# The direction of every sample as seen from the center of the point cloud is
+# binned on an equal area grid, bands of constant width in z times sectors of
+# constant width in azimuth (Archimedes' hat-box theorem).
+
+import numpy as np
+
+
+def direction_bins(X, center, nbands=12, nsectors=24) -> np.ndarray:
+    """
+    Grid cell of the direction of every sample
+    :param X: (n, >=3) array of samples
+    :param center: (3,) array, Point the directions are taken from
+    :param nbands: int, Number of bands in z
+    :param nsectors: int, Number of sectors in azimuth
+    :return: (n,) int array of cell indices
+    """
+    v = X[:, :3] - center
+    norm = np.linalg.norm(v, axis=1)
+    norm[norm == 0] = 1
+    z = v[:, 2] / norm
+    phi = np.arctan2(v[:, 1], v[:, 0])
+    band = np.clip(((z + 1) / 2 * nbands).astype(int), 0, nbands - 1)
+    sector = np.clip(((phi + np.pi) / (2 * np.pi) * nsectors).astype(int), 0, nsectors - 1)
+    return band * nsectors + sector
+
+
+def cell_directions(nbands=12, nsectors=24) -> np.ndarray:
+    """
+    Unit vectors through the middle of every grid cell
+    :return: (nbands * nsectors, 3) array
+    """
+    z = (np.arange(nbands) + 0.5) / nbands * 2 - 1
+    phi = (np.arange(nsectors) + 0.5) / nsectors * 2 * np.pi - np.pi
+    z, phi = np.meshgrid(z, phi, indexing='ij')
+    r = np.sqrt(1 - z ** 2)
+    return np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=-1).reshape(-1, 3)
+
+
+def rank_in_bin(bins) -> np.ndarray:
+    """
+    Position of every element among the elements with the same bin,
+    in the order they appear
+    """
+    order = np.argsort(bins, kind='stable')
+    sorted_bins = bins[order]
+    first = np.searchsorted(sorted_bins, sorted_bins, side='left')
+    rank = np.empty(len(bins), dtype=int)
+    rank[order] = np.arange(len(bins)) - first
+    return rank
+
+
+def thin_samples(X, per_cell=50, center=None, nbands=12, nsectors=24, seed=None) -> np.ndarray:
+    """
+    Balanced subset with at most per_cell randomly chosen samples per direction
+    :param X: (n, >=3) array of samples
+    :param per_cell: int, Cap on the samples kept per grid cell
+    :param center: (3,) array or None, Defaults to the middle of the bounding box
+    :return: (m, >=3) array with m <= per_cell * nbands * nsectors
+    """
+    if center is None:
+        center = (X[:, :3].min(axis=0) + X[:, :3].max(axis=0)) / 2
+    rng = np.random.default_rng(seed)
+    X = X[rng.permutation(len(X))]
+    bins = direction_bins(X, center, nbands, nsectors)
+    return X[rank_in_bin(bins) < per_cell]
+
+
+class CoverageIndex:
+
+    """Incrementally updated coverage of the sample directions"""
+
+    def __init__(self, per_cell=50, nbands=12, nsectors=24, recenter=0.02, seed=None):
+
+        """
+        Every cell keeps a reservoir of at most per_cell samples, so the
+        memory and the cost of a fit on the balanced subset stay bounded.
+        The center is the middle of the bounding box of all samples. When it
+        moves by more than recenter times the radius the reservoirs are
+        binned again.
+        :param per_cell: int, Samples kept per grid cell
+        :param nbands: int, Number of bands in z
+        :param nsectors: int, Number of sectors in azimuth
+        :param recenter: float, Relative movement of the center that triggers rebinning
+        :param seed: int or None, Seed of the reservoir sampling
+        """
+        self.per_cell = per_cell
+        self.nbands = nbands
+        self.nsectors = nsectors
+        self.ncells = nbands * nsectors
+        self.recenter = recenter
+        self.rng = np.random.default_rng(seed)
+
+        self.lo = None
+        self.hi = None
+        self.center = None
+
+        self.reservoir = np.zeros([self.ncells, self.per_cell, 3])
+        # Samples seen per cell and samples held in its reservoir
+        self.seen = np.zeros(self.ncells, dtype=int)
+        self.held = np.zeros(self.ncells, dtype=int)
+
+    def reset(self):
+        self.lo = self.hi = self.center = None
+        self.seen[:] = 0
+        self.held[:] = 0
+
+    def update(self, X):
+        """
+        Add a batch of samples
+        :param X: (n, >=3) array
+        """
+        if len(X) == 0:
+            return
+        X = X[:, :3]
+        lo, hi = X.min(axis=0), X.max(axis=0)
+        self.lo = lo if self.lo is None else np.minimum(self.lo, lo)
+        self.hi = hi if self.hi is None else np.maximum(self.hi, hi)
+        center = (self.lo + self.hi) / 2
+        radius = np.mean(self.hi - self.lo) / 2
+        if self.center is None:
+            self.center = center
+        elif np.linalg.norm(center - self.center) > self.recenter * radius:
+            self.__rebin(center)
+        self.__add(X)
+
+    def __add(self, X):
+        bins = direction_bins(X, self.center, self.nbands, self.nsectors)
+        # Reservoir sampling, the k-th sample of a cell replaces a random
+        # slot with probability per_cell / k once the reservoir is full
+        n = self.seen[bins] + rank_in_bin(bins)
+        slot = np.where(n < self.per_cell, n, (self.rng.random(len(n)) * (n + 1)).astype(int))
+        take = slot < self.per_cell
+        self.reservoir[bins[take], slot[take]] = X[take]
+        self.seen += np.bincount(bins, minlength=self.ncells)
+        self.held = np.minimum(self.seen, self.per_cell)
+
+    def __rebin(self, center):
+        kept = self.samples()
+        self.center = center
+        self.seen[:] = 0
+        self.held[:] = 0
+        self.__add(kept)
+
+    @property
+    def coverage(self) -> float:
+        """Fraction of the directions that hold at least one sample"""
+        return np.count_nonzero(self.held) / self.ncells
+
+    def empty_directions(self) -> np.ndarray:
+        """
+        Unit vectors of the directions without samples
+        :return: (m, 3) array
+        """
+        return cell_directions(self.nbands, self.nsectors)[self.held == 0]
+
+    def missing_axes(self, fraction=0.5) -> list:
+        """
+        Field directions along the sensor axes that have not been seen yet,
+        i.e. where most of the cells within 45 degrees hold no samples
+        :param fraction: float, Share of empty cells that counts as missing
+        :return: list of strings like "+z"
+        """
+        directions = cell_directions(self.nbands, self.nsectors)
+        empty = self.held == 0
+        missing = []
+        for i, name in enumerate("xyz"):
+            for sign in (1, -1):
+                near = sign * directions[:, i] > np.cos(np.pi / 4)
+                if np.mean(empty[near]) > fraction:
+                    missing.append(("+" if sign > 0 else "-") + name)
+        return missing
+
+    def samples(self) -> np.ndarray:
+        """
+        Balanced subset of all samples seen so far, at most per_cell per direction
+        :return: (m, 3) array
+        """
+        mask = np.arange(self.per_cell)[None, :] < self.held[:, None]
+        return self.reservoir[mask]
+
+
+if __name__ == "__main__":
+    print("Coverage of the sensor orientations")
@@ -0,0 +1,255 @@
+# Binary recording format for the collected samples.
+# A file starts with an 8 byte magic, a little endian uint32 giving the
+# length of a JSON header and the header itself, padded with spaces so the
+# samples start on a 64 byte boundary. The samples follow as one contiguous
+# array of rows, each row holding an optional float64 timestamp and the
+# channel values. Rows are only ever appended, and the row count is taken
+# from the file size so a recording that was cut short is still readable.
+
+import argparse
+import json
+import sys
+import time
+from os import path
+import numpy as np
+from utilities import parse_lines
+
+MAGIC = b"MAGREC1\0"
+ALIGNMENT = 64
+
+
+def row_dtype(header) -> np.dtype:
+    """
+    dtype of one row of a recording
+    :param header: dict, Recording header
+    """
+    fields = []
+    if header["timestamps"]:
+        fields.append(("t", "<f8"))
+    fields.append(("x", header["dtype"], (header["channels"],)))
+    return np.dtype(fields)
+
+
+def is_recording(filename) -> bool:
+    """
+    Check whether a file is a binary recording rather than delimited text
+    :param filename: string
+    """
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def read_header(filename):
+    """
+    :param filename: string, Binary recording
+    :return: header dict and the offset of the first sample in bytes
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a binary recording" % filename)
+        size = int.from_bytes(f.read(4), "little")
+        header = json.loads(f.read(size).decode("utf-8"))
+    return header, len(MAGIC) + 4 + size
+
+
+class RecordingWriter:
+
+    """Appends samples to a binary recording"""
+
+    def __init__(self, filename, nchannels=3, dtype="<f8", sample_rate=None, timestamps=True):
+
+        """
+        An existing recording is appended to, its header has to agree with
+        the arguments. Otherwise a new file is started.
+        :param filename: string, File to write to
+        :param nchannels: int, Number of values per sample
+        :param dtype: numpy dtype of the values, "<f4" or "<f8"
+        :param sample_rate: float or None, Nominal sample rate of the sensor in Hz
+        :param timestamps: bool, Store a float64 time in seconds with every sample
+        """
+        self.filename = filename
+        if path.isfile(filename) and path.getsize(filename) > 0:
+            self.header, self.offset = read_header(filename)
+            if self.header["channels"] != nchannels or np.dtype(self.header["dtype"]) != np.dtype(dtype):
+                raise ValueError("%s holds samples of another layout" % filename)
+        else:
+            self.header = {"version": 1, "channels": nchannels, "dtype": np.dtype(dtype).str,
+                           "sample_rate": sample_rate, "timestamps": timestamps,
+                           "start_time": time.time()}
+            raw = json.dumps(self.header).encode("utf-8")
+            pad = -(len(MAGIC) + 4 + len(raw)) % ALIGNMENT
+            raw += b" " * pad
+            with open(filename, "wb") as f:
+                f.write(MAGIC + len(raw).to_bytes(4, "little") + raw)
+            self.offset = len(MAGIC) + 4 + len(raw)
+        self.dtype = row_dtype(self.header)
+        self.file = open(filename, "ab")
+        # Drop a partial row left by an interrupted writer
+        self.file.truncate(self.offset + (path.getsize(filename) - self.offset) // self.dtype.itemsize
+                           * self.dtype.itemsize)
+
+    def append(self, samples, timestamps=None):
+        """
+        :param samples: (n, nchannels) array
+        :param timestamps: (n,) array or None, Defaults to the current time for the whole block
+        """
+        rows = np.empty(len(samples), dtype=self.dtype)
+        rows["x"] = samples
+        if self.header["timestamps"]:
+            rows["t"] = time.time() if timestamps is None else timestamps
+        self.file.write(rows.tobytes())
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CsvWriter:
+
+    """Appends samples to a delimited text file, the same interface as RecordingWriter"""
+
+    def __init__(self, filename, delimiter=","):
+        self.filename = filename
+        self.delimiter = delimiter
+        self.file = open(filename, "a")
+
+    def append(self, samples, timestamps=None):
+        np.savetxt(self.file, samples, delimiter=self.delimiter)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def open_writer(filename, delimiter=",", nchannels=3):
+    """
+    Writer matching the file, binary for the .mrec extension or an existing
+    binary recording, delimited text otherwise
+    :param filename: string
+    :param delimiter: string, Delimiter of text files
+    :param nchannels: int, Number of values per sample
+    """
+    if filename.endswith(".mrec") or is_recording(filename):
+        return RecordingWriter(filename, nchannels)
+    return CsvWriter(filename, delimiter)
+
+
+def open_recording(filename):
+    """
+    Memory map a binary recording, nothing is read until it is used
+    :param filename: string
+    :return: header dict and a structured memmap of the rows
+    """
+    header, offset = read_header(filename)
+    dtype = row_dtype(header)
+    n = (path.getsize(filename) - offset) // dtype.itemsize
+    if n == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(n,))
+
+
+def load_samples(filename, delimiter=","):
+    """
+    Samples of a recording in either format. Binary recordings are returned
+    as a view on the memory map.
+    :param filename: string
+    :param delimiter: string, Delimiter of text files
+    :return: (n, nchannels) array
+    """
+    if is_recording(filename):
+        header, rows = open_recording(filename)
+        return rows["x"]
+    return np.loadtxt(filename, delimiter=delimiter, ndmin=2)
+
+
+def text_channels(csv_file, delimiter=","):
+    """
+    :param csv_file: string, Delimited text recording
+    :return: int, Number of values on the first non-blank line, 0 for an empty file
+    """
+    delim = delimiter.encode("utf-8")
+    with open(csv_file, "rb") as f:
+        for line in f:
+            if line.strip():
+                return line.count(delim) + 1
+    return 0
+
+
+def csv_to_recording(csv_file, filename, delimiter=",", nchannels=None, dtype="<f8", chunk_lines=100000):
+    """
+    Convert a delimited text recording, malformed lines are skipped
+    :param nchannels: int or None, Values per sample, None takes the count of the first line
+    :return: int, Number of samples written
+    :raises ValueError: if there are more malformed lines than samples
+    """
+    if nchannels is None:
+        nchannels = text_channels(csv_file, delimiter)
+        if nchannels == 0:
+            raise ValueError("%s holds no samples" % csv_file)
+    # Start over instead of appending to an older conversion
+    open(filename, "wb").close()
+    writer = RecordingWriter(filename, nchannels, dtype, timestamps=False)
+    count = 0
+    n_bad = 0
+    with open(csv_file, "rb") as f:
+        while True:
+            lines = f.readlines(chunk_lines * 32)
+            if len(lines) == 0:
+                break
+            data, n = parse_lines([ln.rstrip(b"\r\n") for ln in lines], nchannels, delimiter)
+            writer.append(data)
+            count += len(data)
+            n_bad += n
+    writer.close()
+    if n_bad > count:
+        raise ValueError("%d of %d lines of %s do not hold %d values"
+                         % (n_bad, n_bad + count, csv_file, nchannels))
+    if n_bad > 0:
+        print("Skipped %d malformed lines" % n_bad)
+    return count
+
+
+def recording_to_csv(filename, csv_file, delimiter=",", chunk=100000):
+    """
+    Convert a binary recording into delimited text, without timestamps
+    :return: int, Number of samples written
+    """
+    header, rows = open_recording(filename)
+    with open(csv_file, "w") as f:
+        for i in range(0, len(rows), chunk):
+            np.savetxt(f, rows["x"][i:i + chunk], delimiter=delimiter)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert recordings between delimited text and binary")
+    parser.add_argument("source", help="Recording to convert")
+    parser.add_argument("target", help="Output file, binary if it ends in .mrec, text otherwise")
+    parser.add_argument("-d", "--delimiter", default=",", help="Delimiter of the text file")
+    parser.add_argument("-n", "--channels", type=int, default=None,
+                        help="Values per sample of the text file, by default those of its first line")
+    parser.add_argument("--float32", action="store_true", help="Store single precision values")
+    args = parser.parse_args()
+
+    try:
+        if args.target.endswith(".mrec"):
+            n = csv_to_recording(args.source, args.target, args.delimiter, args.channels,
+                                 dtype="<f4" if args.float32 else "<f8")
+        else:
+            n = recording_to_csv(args.source, args.target, args.delimiter)
+    except (OSError, ValueError) as e:
+        print("Conversion failed: %s" % e)
+        return 1
+    print("Converted %d samples" % n)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+# Nonlinear refinement of a calibration. The closed-form fit minimizes an
+# algebraic error, this minimizes the geometric one, the calibrated magnitude
+# minus the field, with Levenberg-Marquardt steps on all samples at once.
+# U is kept symmetric as in fit_ellipsoid: |(x - c) U| does not change when U
+# is multiplied by a rotation from the right, the symmetric U is the one
+# choice among those. The covariance of the parameters follows from the
+# Jacobian at the solution.
+
+import numpy as np
+
+# Entries of the symmetric U that are fitted, the first three on the diagonal
+U_INDEX = ((0, 1, 2, 0, 0, 1), (0, 1, 2, 1, 2, 2))
+
+
+def magnitude_residuals(X, U, c, field=1.0, jacobian=False):
+    """
+    :param X: (N, 3) array of samples
+    :param U: (3, 3) symmetric array
+    :param c: (3,) array
+    :param field: float, Expected magnitude
+    :param jacobian: bool, Also return the derivatives
+    :return: (N,) residuals |(x - c) U| - field, and with jacobian the (N, 9)
+    derivatives by the six entries of U in U_INDEX order followed by c
+    """
+    Y = X - c
+    Z = Y @ U
+    n = np.sqrt(np.einsum('ni,ni->n', Z, Z))
+    r = n - field
+    if not jacobian:
+        return r
+    W = Z / n[:, None]
+    J = np.empty([len(X), 9])
+    # d|z|/dU_jk = y_j w_k, an off-diagonal entry appears twice
+    J[:, 0:3] = Y * W
+    J[:, 3] = Y[:, 0] * W[:, 1] + Y[:, 1] * W[:, 0]
+    J[:, 4] = Y[:, 0] * W[:, 2] + Y[:, 2] * W[:, 0]
+    J[:, 5] = Y[:, 1] * W[:, 2] + Y[:, 2] * W[:, 1]
+    # dz/dc = -U, so d|z|/dc = -U w
+    J[:, 6:9] = -W @ U.T
+    return r, J
+
+
+def refine_fit(X, U, c, field=1.0, max_iterations=50, tolerance=1e-10):
+
+    """
+    Levenberg-Marquardt refinement of a calibration
+    :param X: (N, >=3) array of samples, outliers should already be removed
+    :param U: (3, 3) array, Start value, e.g. from fit_ellipsoid, made symmetric
+    :param c: (3,) array, Start value of the offset
+    :param field: float, Magnitude the calibrated samples should have
+    :param max_iterations: int, Upper bound on the steps
+    :param tolerance: float, Relative decrease of the squared residuals at which to stop
+    :return: U, c and a dict with the standard errors U_std and c_std, the 9x9
+    covariance of the parameters, the rms and max residual, the number of
+    iterations and whether it converged. None if there are too few samples.
+    """
+    X = np.asarray(X, dtype=float)[:, :3]
+    N = len(X)
+    if N <= 9:
+        print("Too few values to perform fitting")
+        return None
+    p = np.concatenate([np.asarray(U, dtype=float)[U_INDEX], np.asarray(c, dtype=float)])
+
+    def unpack(p):
+        S = np.empty([3, 3])
+        S[U_INDEX] = p[:6]
+        S[U_INDEX[::-1]] = p[:6]
+        return S, p[6:]
+
+    r, J = magnitude_residuals(X, *unpack(p), field, jacobian=True)
+    cost = r @ r
+    lam = 1e-3
+    converged = False
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        H = J.T @ J
+        g = J.T @ r
+        # Marquardt's scaling by the diagonal, so the damping is unit free
+        D = np.diag(np.diag(H))
+        while True:
+            try:
+                step = np.linalg.solve(H + lam * D, -g)
+            except np.linalg.LinAlgError:
+                step = None
+            if step is not None:
+                r_new, J_new = magnitude_residuals(X, *unpack(p + step), field, jacobian=True)
+                cost_new = r_new @ r_new
+                if np.isfinite(cost_new) and cost_new <= cost:
+                    break
+            lam *= 10
+            if lam > 1e12:
+                break
+        if lam > 1e12:
+            break
+        p += step
+        decrease = (cost - cost_new) / max(cost, np.finfo(float).tiny)
+        r, J, cost = r_new, J_new, cost_new
+        lam = max(lam / 10, 1e-12)
+        if decrease < tolerance:
+            converged = True
+            break
+
+    U, c = unpack(p)
+    sigma2 = cost / (N - 9)
+    try:
+        covariance = sigma2 * np.linalg.inv(J.T @ J)
+    except np.linalg.LinAlgError:
+        covariance = np.full([9, 9], np.nan)
+    std = np.sqrt(np.abs(np.diag(covariance)))
+    U_std = np.empty([3, 3])
+    U_std[U_INDEX] = std[:6]
+    U_std[U_INDEX[::-1]] = std[:6]
+    info = {"U_std": U_std, "c_std": std[6:], "covariance": covariance,
+            "rms": float(np.sqrt(cost / N)), "max": float(np.abs(r).max()),
+            "iterations": iteration, "converged": converged}
+    return U, c, info
+
+
+if __name__ == "__main__":
+    print("Nonlinear refinement of a calibration")
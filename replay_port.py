@@ -0,0 +1,264 @@
+# Replay of a recording as if it came from a sensor. ReplaySerial stands in for
+# the pyserial object: it formats the recorded samples into the bytes the
+# firmware would send and releases them on the recorded time line, scaled by
+# a speed factor, optionally with delivery jitter and corrupted lines.
+# ReplayPort is a SerialPort on top of it, so replays go through exactly the
+# parsing, acquisition, plotting and saving of a live session.
+
+import argparse
+import sys
+import time
+from urllib.parse import urlsplit, parse_qs, unquote
+import numpy as np
+import serial
+from serial_port import SerialPort
+from acquisition import AcquisitionThread
+from recording import is_recording, open_recording, load_samples
+from simulated_device import format_lines
+from binary_protocol import encode_frames
+
+# Port names starting with this are opened as a replay, see ReplayPort.from_url
+REPLAY_SCHEME = "replay://"
+
+
+def recording_times(filename, samples, rate=100.0) -> np.ndarray:
+    """
+    Time line of a recording in seconds from its first sample
+    :param filename: string, Recording
+    :param samples: (n, nchannels) array, Its samples
+    :param rate: float, Sample rate assumed when the recording has neither
+    timestamps nor a nominal rate, e.g. delimited text
+    :return: (n,) non-decreasing array
+    """
+    if is_recording(filename):
+        header, rows = open_recording(filename)
+        if header["timestamps"] and len(rows) > 0:
+            t = np.maximum.accumulate(np.asarray(rows["t"], dtype=float))
+            return t - t[0]
+        rate = header.get("sample_rate") or rate
+    return np.arange(len(samples)) / rate
+
+
+class ReplaySerial:
+
+    """Serial port like object that sends recorded samples on their time line"""
+
+    def __init__(self, samples, times, speed=1.0, jitter=0.0, error_rate=0.0, delimiter=",",
+                 protocol="ascii", frame_scale=1.0, fmt="%.9g", block=1024, max_buffer=65536,
+                 timeout=1.0, seed=0):
+
+        """
+        :param samples: (n, nchannels) array
+        :param times: (n,) array, Seconds of every sample from the start
+        :param speed: float or None, Factor on the recorded rate, None sends as
+        fast as the reader takes the bytes
+        :param jitter: float, Standard deviation in seconds of an extra delay of
+        every sample, like a USB adapter holding bytes back. The order is kept.
+        :param error_rate: float, Share of lines truncated or garbled, or of
+        binary frames with a flipped byte
+        :param delimiter: string, Delimiter of the lines
+        :param protocol: string, "ascii" lines or "binary" int16 frames
+        :param frame_scale: float, Physical value of one count in binary frames
+        :param fmt: string, printf format of the values in ascii lines
+        :param block: int, Most samples encoded at once
+        :param max_buffer: int, Bytes held for the reader before the replay waits for it
+        :param timeout: float, Seconds read and readline wait for data
+        :param seed: int, Seed of the jitter and the corruption
+        """
+        self.samples = samples
+        self.rng = np.random.default_rng(seed)
+        if speed is None:
+            self.due = np.zeros(len(samples))
+        else:
+            self.due = np.asarray(times, dtype=float) / speed
+        if jitter > 0:
+            self.due = np.maximum.accumulate(self.due + np.abs(self.rng.normal(0, jitter, len(samples))))
+        self.error_rate = error_rate
+        self.delimiter = delimiter
+        self.protocol = protocol
+        self.frame_scale = frame_scale
+        self.fmt = fmt
+        self.block = block
+        self.max_buffer = max_buffer
+        self.timeout = timeout
+
+        # Samples encoded so far, of those corrupted, and the bytes not yet read
+        self.position = 0
+        self.corrupted = 0
+        self.__buffer = bytearray()
+        self.__open = True
+        self.start = time.monotonic()
+
+    @property
+    def finished(self) -> bool:
+        """Everything was sent and read"""
+        return self.position >= len(self.samples) and len(self.__buffer) == 0
+
+    @property
+    def in_waiting(self) -> int:
+        self.__check_open()
+        self.__pump()
+        return len(self.__buffer)
+
+    def isOpen(self) -> bool:
+        return self.__open
+
+    def close(self):
+        self.__open = False
+
+    def __check_open(self):
+        if not self.__open:
+            raise serial.PortNotOpenError()
+
+    def __encode(self, samples):
+        if self.protocol == "binary":
+            raw = bytearray(encode_frames(samples, start_counter=self.position, scale=self.frame_scale))
+            n_bad = 0
+            if self.error_rate > 0:
+                frame = len(raw) // len(samples)
+                bad = np.flatnonzero(self.rng.random(len(samples)) < self.error_rate)
+                for i in bad:
+                    raw[i * frame + self.rng.integers(frame)] ^= 0xFF
+                n_bad = len(bad)
+            return raw, n_bad
+        return format_lines(samples, self.delimiter, self.error_rate, self.rng, self.fmt)
+
+    def __pump(self):
+        # Encode the samples that are due, a block at a time while the reader keeps up
+        now = time.monotonic() - self.start
+        while self.position < len(self.samples) and len(self.__buffer) < self.max_buffer:
+            stop = min(int(np.searchsorted(self.due, now, side='right')), self.position + self.block)
+            if stop <= self.position:
+                return
+            raw, n_bad = self.__encode(self.samples[self.position:stop])
+            self.__buffer += raw
+            self.corrupted += n_bad
+            self.position = stop
+
+    def __wait(self, ready):
+        # Pump until ready() holds, the replay is over or the timeout passes
+        deadline = time.monotonic() + self.timeout
+        while True:
+            self.__pump()
+            if ready() or self.position >= len(self.samples):
+                return
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            next_due = self.start + self.due[self.position]
+            time.sleep(max(0.0, min(deadline, next_due) - now))
+
+    def read(self, size=1) -> bytes:
+        self.__check_open()
+        self.__wait(lambda: len(self.__buffer) >= size)
+        out = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return out
+
+    def readline(self) -> bytes:
+        self.__check_open()
+        self.__wait(lambda: b"\n" in self.__buffer)
+        end = self.__buffer.find(b"\n") + 1 or len(self.__buffer)
+        out = bytes(self.__buffer[:end])
+        del self.__buffer[:end]
+        return out
+
+
+class ReplayPort(SerialPort):
+
+    """SerialPort that reads a recording instead of a device"""
+
+    def __init__(self, recording, foldername, filename="trial.txt", speed=1.0, jitter=0.0,
+                 error_rate=0.0, rate=100.0, seed=0, **kwargs):
+
+        """
+        :param recording: string, Recording to replay, delimited text or binary
+        :param foldername: string, Folder of the output, as for SerialPort
+        :param filename: string, Output file name, as for SerialPort
+        :param speed: float or None, Factor on the recorded rate, None for as fast as possible
+        :param jitter: float, Delivery jitter in seconds, see ReplaySerial
+        :param error_rate: float, Share of corrupted lines
+        :param rate: float, Sample rate of recordings without timestamps
+        :param seed: int, Seed of the jitter and the corruption
+        :param kwargs: Other arguments of SerialPort, e.g. nchannels, delimiter and protocol
+        """
+        super().__init__(recording, foldername, filename, **kwargs)
+        self.speed = speed
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate = rate
+        self.seed = seed
+        self.frame_scale = kwargs.get("frame_scale", 1.0)
+
+    @classmethod
+    def from_url(cls, url, foldername, filename="trial.txt", **kwargs):
+        """
+        :param url: string, replay://<recording>?speed=10&jitter=0.002&errors=0.01,
+        speed=0 replays as fast as possible
+        :param kwargs: Other arguments of ReplayPort
+        :return: ReplayPort
+        """
+        parts = urlsplit(url)
+        query = {key: float(values[-1]) for key, values in parse_qs(parts.query).items()}
+        speed = query.get("speed", 1.0)
+        return cls(unquote(parts.netloc + parts.path), foldername, filename, speed=speed or None,
+                   jitter=query.get("jitter", 0.0), error_rate=query.get("errors", 0.0), **kwargs)
+
+    def open_port(self):
+        try:
+            samples = load_samples(self.port, self.delimiter)
+        except (OSError, ValueError):
+            print("Recording %s cannot be read" % self.port)
+            raise serial.SerialException
+        if samples.shape[1] < self.nchannels:
+            print("Recording %s holds %d values per sample, %d expected"
+                  % (self.port, samples.shape[1], self.nchannels))
+            raise serial.SerialException
+        times = recording_times(self.port, samples, self.rate)
+        self.serial_port = ReplaySerial(samples[:, :self.nchannels], times, self.speed, self.jitter,
+                                        self.error_rate, self.delimiter, self.protocol, self.frame_scale,
+                                        seed=self.seed)
+        self.running = True
+
+    def read_chunk(self) -> np.ndarray:
+        data = super().read_chunk()
+        if self.serial_port.finished:
+            # End of the recording, the acquisition stops like on a lost port
+            self.running = False
+        return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recording through the acquisition path and time it")
+    parser.add_argument("recording", help="Delimited text or binary recording")
+    parser.add_argument("-s", "--speed", type=float, default=0.0,
+                        help="Factor on the recorded rate, 0 for as fast as possible (default)")
+    parser.add_argument("-j", "--jitter", type=float, default=0.0, help="Delivery jitter in seconds")
+    parser.add_argument("-e", "--errors", type=float, default=0.0, help="Share of corrupted lines")
+    parser.add_argument("-n", "--nchannels", type=int, default=3, help="Values per sample")
+    parser.add_argument("-d", "--delimiter", default=",", help="Delimiter of text recordings and of the lines")
+    parser.add_argument("-p", "--protocol", default="ascii", choices=("ascii", "binary"))
+    parser.add_argument("-r", "--rate", type=float, default=100.0, help="Sample rate of recordings without timestamps")
+    args = parser.parse_args()
+
+    sp = ReplayPort(args.recording, ".", speed=args.speed or None, jitter=args.jitter, error_rate=args.errors,
+                    rate=args.rate, nchannels=args.nchannels, delimiter=args.delimiter, protocol=args.protocol,
+                    frame_scale=0.01)
+    sp.open_port()
+    acq = AcquisitionThread(sp, capacity=1 << 20)
+    t0 = time.perf_counter()
+    acq.start()
+    received = 0
+    while acq.is_alive():
+        received += len(acq.ring.drain())
+        time.sleep(0.02)
+    received += len(acq.ring.drain())
+    elapsed = time.perf_counter() - t0
+    print("%d samples in %.2f s, %.0f samples/s, %d lines, %d dropped, %d corrupted, %d overruns"
+          % (received, elapsed, received / elapsed, sp.total_lines, acq.dropped, sp.serial_port.corrupted,
+             acq.overruns))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
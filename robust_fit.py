@@ -0,0 +1,118 @@
+# Outlier rejecting variant of fit_ellipsoid. Candidate ellipsoids are fitted
+# to random minimal samples (RANSAC) and scored against a subset of the data,
+# the best one seeds an iteratively reweighted least squares fit of all the
+# samples with the same algebraic method as fit_ellipsoid.
+
+import numpy as np
+from fit_ellipsoid import design_matrix, ellipsoid_parameters
+
+
+def radial_residuals(p, X) -> np.ndarray:
+    """
+    Relative distance of the samples from the surface of the quadric, i.e.
+    the calibrated magnitude minus one. Evaluated for many quadrics at once.
+    :param p: (H, 10) array of quadric coefficients
+    :param X: (N, 3) array of samples
+    :return: (H, N) array, inf for quadrics that are not ellipsoids
+    """
+    A = np.stack([
+        np.stack([p[:, 0], p[:, 3] / 2, p[:, 4] / 2], axis=-1),
+        np.stack([p[:, 3] / 2, p[:, 1], p[:, 5] / 2], axis=-1),
+        np.stack([p[:, 4] / 2, p[:, 5] / 2, p[:, 2]], axis=-1)], axis=1)
+    # Flip the sign so A is positive definite for ellipsoids
+    sign = np.where(np.linalg.eigvalsh(A)[:, 0] < 0, -1.0, 1.0)
+    A *= sign[:, None, None]
+    b = p[:, 6:9] * sign[:, None]
+    d = p[:, 9] * sign
+    valid = np.linalg.eigvalsh(A)[:, 0] > 0
+    A[~valid] = np.eye(3)
+
+    # Center and squared radius of (x - c)^T A (x - c) = k
+    c = -0.5 * np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    k = np.einsum('hi,hij,hj->h', c, A, c) - d
+    valid &= k > 0
+    k[~valid] = 1
+
+    Y = X[None, :, :] - c[:, None, :]
+    q = np.einsum('hni,hij,hnj->hn', Y, A, Y, optimize=True) / k[:, None]
+    r = np.sqrt(np.abs(q)) - 1
+    r[~valid] = np.inf
+    return r
+
+
+def minimal_hypotheses(X, n_hypotheses, sample_size, rng) -> np.ndarray:
+    """
+    Quadrics through random subsets of the samples
+    :return: (n_hypotheses, 10) array
+    """
+    idx = np.array([rng.choice(len(X), sample_size, replace=False) for _ in range(n_hypotheses)])
+    D = design_matrix(X[idx.ravel()]).reshape(n_hypotheses, sample_size, 10)
+    # Smallest right singular vector of every sample, the exact solution for 9 points
+    _, _, V = np.linalg.svd(D, full_matrices=True)
+    return V[:, -1, :]
+
+
+def fit_ellipsoid_robust(X, threshold=0.05, n_hypotheses=200, sample_size=9,
+                         score_points=2000, iterations=20, seed=None):
+
+    """
+    :param X: (N, >=3) array of samples
+    :param threshold: float, Relative magnitude error above which a sample is an outlier
+    :param n_hypotheses: int, Number of random minimal fits
+    :param sample_size: int, Samples per minimal fit, 9 is the minimum
+    :param score_points: int, Samples the minimal fits are scored against
+    :param iterations: int, Maximum number of reweighting steps
+    :param seed: int or None, Seed of the random sampling
+    :return: U, c, inlier mask and a dict of residual statistics of the inliers,
+    or None if no ellipsoid could be fitted
+    """
+    if len(X.shape) != 2 or X.shape[0] < max(10, sample_size):
+        print("Too few values to perform fitting")
+        return None
+    X = X[:, :3]
+    rng = np.random.default_rng(seed)
+
+    # RANSAC, keep the candidate that explains most of a random subset
+    subset = X[rng.choice(len(X), min(score_points, len(X)), replace=False)]
+    hypotheses = minimal_hypotheses(X, n_hypotheses, sample_size, rng)
+    scores = np.count_nonzero(np.abs(radial_residuals(hypotheses, subset)) < threshold, axis=1)
+    if scores.max() < 10:
+        print("No consistent ellipsoid found. Need more data or retake trial")
+        return None
+    p = hypotheses[np.argmax(scores)]
+
+    # Iteratively reweighted least squares with Tukey's biweight, samples
+    # beyond the threshold get no weight at all
+    D = design_matrix(X)
+    for _ in range(iterations):
+        r = radial_residuals(p[None, :], X)[0]
+        w = np.clip(1 - (r / threshold) ** 2, 0, None) ** 2
+        inliers = w > 0
+        if np.count_nonzero(inliers) < 10:
+            print("Too few inliers to perform fitting")
+            return None
+        D_tri = np.linalg.qr(np.sqrt(w[inliers])[:, None] * D[inliers], mode='r')
+        p_new = np.linalg.svd(D_tri)[2][-1]
+        converged = 1 - abs(np.dot(p_new, p)) < 1e-12
+        p = p_new
+        if converged:
+            break
+
+    params = ellipsoid_parameters(D_tri)
+    if params is None:
+        return None
+    U, c = params
+    r = np.abs(radial_residuals(p[None, :], X)[0])
+    inliers = r < threshold
+    # The last reweighting step may have moved the fit away from its inliers
+    if np.count_nonzero(inliers) < 10:
+        print("Too few inliers to perform fitting")
+        return None
+    stats = {"inliers": int(np.count_nonzero(inliers)), "outliers": int(np.count_nonzero(~inliers)),
+             "rms": float(np.sqrt(np.mean(r[inliers] ** 2))), "median": float(np.median(r[inliers])),
+             "max": float(r[inliers].max())}
+    return U, c, inliers, stats
+
+
+if __name__ == "__main__":
+    print("Outlier rejecting ellipsoid fit")
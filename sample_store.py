@@ -0,0 +1,138 @@
+# In-memory store of the samples of a session. Rows live in one contiguous
+# array that doubles when full, so appending is amortized O(1) and readers
+# get views without copying. With a memory budget the store stops growing
+# and either decimates in time or keeps a uniform random reservoir.
+
+import numpy as np
+
+
+class SampleStore:
+
+    """Growable array of samples with timestamps"""
+
+    def __init__(self, nchannels=3, capacity=4096, max_samples=None, mode="decimate", dtype=float, seed=None):
+
+        """
+        Views returned by samples and timestamps stay valid until the next
+        append. They are never written to afterwards, except by decimation
+        which compacts the rows in place.
+        :param nchannels: int, Number of values per sample
+        :param capacity: int, Initial number of rows, doubled when full
+        :param max_samples: int or None, Budget in samples, None grows without bound
+        :param mode: string, What to do at the budget, "decimate" halves the
+        time resolution whenever the store is full, keeping every 2^k-th sample
+        in order. "reservoir" keeps a uniform random subset of everything seen.
+        :param dtype: numpy dtype of the values
+        :param seed: int or None, Seed of the reservoir sampling
+        """
+        if mode not in ("decimate", "reservoir"):
+            raise ValueError("Unknown mode %s" % mode)
+        self.nchannels = nchannels
+        self.max_samples = max_samples
+        self.mode = mode
+        self.rng = np.random.default_rng(seed)
+        if max_samples is not None:
+            capacity = min(capacity, max_samples)
+        self.data = np.zeros([capacity, nchannels], dtype=dtype)
+        self.time = np.zeros(capacity, dtype=float)
+        self.count = 0
+        # Samples appended in total and the current decimation stride
+        self.seen = 0
+        self.stride = 1
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def samples(self) -> np.ndarray:
+        """(n, nchannels) view of the stored samples"""
+        return self.data[:self.count]
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        """(n,) view of the times of the stored samples"""
+        return self.time[:self.count]
+
+    def clear(self):
+        self.count = 0
+        self.seen = 0
+        self.stride = 1
+
+    def __reserve(self, n):
+        if self.count + n <= len(self.data):
+            return
+        capacity = len(self.data)
+        while capacity < self.count + n:
+            capacity *= 2
+        if self.max_samples is not None:
+            capacity = min(capacity, self.max_samples)
+        data = np.zeros([capacity, self.nchannels], dtype=self.data.dtype)
+        data[:self.count] = self.data[:self.count]
+        self.data = data
+        t = np.zeros(capacity, dtype=float)
+        t[:self.count] = self.time[:self.count]
+        self.time = t
+
+    def __store(self, samples, timestamps):
+        n = len(samples)
+        self.__reserve(n)
+        self.data[self.count:self.count + n] = samples
+        self.time[self.count:self.count + n] = timestamps
+        self.count += n
+
+    def append(self, samples, timestamps=None):
+        """
+        :param samples: (n, >=nchannels) array, extra columns are ignored
+        :param timestamps: (n,) array, float or None, None uses 0
+        """
+        samples = samples[:, :self.nchannels]
+        n = len(samples)
+        if n == 0:
+            return
+        timestamps = np.broadcast_to(0.0 if timestamps is None else timestamps, (n,))
+        if self.max_samples is None:
+            self.__store(samples, timestamps)
+        elif self.mode == "decimate":
+            self.__append_decimated(samples, timestamps)
+        else:
+            self.__append_reservoir(samples, timestamps)
+        self.seen += n
+
+    def __append_decimated(self, samples, timestamps):
+        # Keep the samples whose running index is a multiple of the stride
+        start = self.seen
+        while len(samples) > 0:
+            offset = -start % self.stride
+            room = self.max_samples - self.count
+            take = samples[offset::self.stride][:room]
+            self.__store(take, timestamps[offset::self.stride][:room])
+            used = offset + len(take) * self.stride
+            samples = samples[used:]
+            timestamps = timestamps[used:]
+            start += used
+            if self.count == self.max_samples and len(samples) > 0:
+                # Full, drop every other sample and halve the rate from here on
+                half = (self.count + 1) // 2
+                self.data[:half] = self.data[:self.count:2]
+                self.time[:half] = self.time[:self.count:2]
+                self.count = half
+                self.stride *= 2
+
+    def __append_reservoir(self, samples, timestamps):
+        room = self.max_samples - self.count
+        if room > 0:
+            self.__store(samples[:room], timestamps[:room])
+            samples = samples[room:]
+            timestamps = timestamps[room:]
+        if len(samples) == 0:
+            return
+        # Algorithm R, the k-th sample replaces a random slot with probability max_samples / (k + 1)
+        k = self.seen + room + np.arange(len(samples))
+        slot = (self.rng.random(len(samples)) * (k + 1)).astype(int)
+        take = slot < self.max_samples
+        self.data[slot[take]] = samples[take]
+        self.time[slot[take]] = timestamps[take]
+
+
+if __name__ == "__main__":
+    print("In-memory store of the session samples")
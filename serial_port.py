@@ -1,7 +1,9 @@
 import serial
 from datetime import datetime
 from os import path, mkdir, getpid
-from utilities import convert_to_array
+from utilities import convert_to_array, parse_lines
+from binary_protocol import FrameDecoder
+from instrumentation import Metrics
 import numpy as np
 
 
@@ -10,7 +12,8 @@ class SerialPort:
     """"Serial port object that works with multiprocessing"""
 
     def __init__(self, port, foldername, filename="trial.txt",
-                 baudrate=115200, buffersize=100, nchannels=3, delimiter=","):
+                 baudrate=115200, buffersize=100, nchannels=3, delimiter=",",
+                 protocol="ascii", frame_values="int16", frame_scale=1.0, metrics=None):
 
         """
         :param port: string, The string referencing the serial port name as
@@ -20,6 +23,12 @@ class SerialPort:
         :param filename: string, filename to save the data in
         :param baudrate: int, baudrate of the serial communication device
         :param delimiter: string, Expected delimiter in serial data
+        :param protocol: string, "ascii" for delimited text lines or "binary" for
+        the framed protocol of binary_protocol.py
+        :param frame_values: string, "int16" or "float32" values in binary frames
+        :param frame_scale: float, Physical value of one count in binary frames
+        :param metrics: Metrics or None, Collects the read and parse timings, a
+        disabled one by default
         """
         self.port = port
 
@@ -36,9 +45,21 @@ class SerialPort:
         self.running = False
 
         self.total_lines = 0
+        self.parse_errors = 0
+
+        # Bytes after the last newline of the previous chunk
+        self.__partial = b""
+        self.max_line_length = 1024
+
+        self.protocol = protocol
+        self.decoder = None
+        if self.protocol == "binary":
+            self.decoder = FrameDecoder(self.nchannels, frame_values, frame_scale)
 
         self.data_buffer = np.zeros([self.buffersize, self.nchannels], dtype=float)
 
+        self.metrics = Metrics() if metrics is None else metrics
+
     def read_port(self) -> bytearray | None:
         """
         Read serial port and return the bytes object. If unable to return,
@@ -56,6 +77,7 @@ class SerialPort:
         """
         Wrapper function to close the serial port
         """
+        self.running = False
         self.serial_port.close()
 
     def isOpen(self) -> bool:
@@ -70,12 +92,56 @@ class SerialPort:
 
     def open_port(self):
         try:
-            self.serial_port = serial.Serial(self.port, self.baudrate, timeout=1)
+            # Also accepts pyserial URLs such as loop:// or socket://host:port
+            self.serial_port = serial.serial_for_url(self.port, self.baudrate, timeout=1)
+            self.running = True
         except serial.SerialException:
             print("Port %s not connected or busy" % self.port)
             print("Port %s was stopped in process %d" % (self.port, getpid()))
             raise serial.SerialException
 
+    def read_chunk(self) -> np.ndarray:
+        """
+        Read everything waiting in the serial input buffer, blocking for at
+        most the port timeout if nothing has arrived yet, and parse all the
+        complete lines in one go. An incomplete trailing line is kept for
+        the next call. In binary mode the bytes go through the frame decoder
+        instead.
+        :return: (n, nchannels) array, possibly empty
+        """
+        metrics = self.metrics
+        with metrics.stage("read"):
+            try:
+                raw = self.serial_port.read(max(1, self.serial_port.in_waiting))
+            except serial.SerialException:
+                self.running = False
+                raw = b""
+        metrics.count("bytes", len(raw))
+        if self.decoder is not None:
+            with metrics.stage("parse"):
+                data = self.decoder.feed(raw)
+            metrics.count("lines", self.decoder.frames - self.total_lines)
+            metrics.count("parse_errors", self.decoder.crc_errors - self.parse_errors)
+            self.total_lines = self.decoder.frames
+            self.parse_errors = self.decoder.crc_errors
+            return data
+        with metrics.stage("parse"):
+            lines = (self.__partial + raw).split(b"\n")
+            self.__partial = lines.pop()
+            if len(self.__partial) > self.max_line_length:
+                # No newline in sight, the stream is garbage
+                self.__partial = b""
+                n_bad = 1
+            else:
+                n_bad = 0
+            data, n = parse_lines(lines, self.nchannels, self.delimiter)
+            n_bad += n
+        self.total_lines += len(lines)
+        self.parse_errors += n_bad
+        metrics.count("lines", len(lines))
+        metrics.count("parse_errors", n_bad)
+        return data
+
     def fill_buffer(self):
 
         i = 0
@@ -87,6 +153,8 @@ class SerialPort:
                 self.data_buffer[i] = data
                 i += 1
             except ValueError:
+                self.parse_errors += 1
+                self.metrics.count("parse_errors")
                 continue
 
 
@@ -0,0 +1,178 @@
+# Stand-in for a magnetometer board for tests and benchmarks without hardware.
+# The device writes to the master side of a pseudo terminal and SerialPort
+# opens the slave side like any other serial port. Pseudo terminals are only
+# available on POSIX systems.
+
+import os
+import threading
+import time
+import numpy as np
+from binary_protocol import encode_frames
+
+try:
+    import tty
+except ImportError:
+    # Not available on Windows, the synthetic data still is
+    tty = None
+
+
+class SyntheticSensor:
+
+    """Magnetometer with soft-iron and hard-iron distortions, rotated at random"""
+
+    def __init__(self, radius=50.0, noise=0.5, distortion=0.1, seed=0):
+
+        """
+        :param radius: float, Field magnitude the sensor would read without distortions
+        :param noise: float, Standard deviation of the white noise on every axis
+        :param distortion: float, Standard deviation of the soft-iron matrix around identity
+        :param seed: int, Seed of the distortions and the orientations
+        """
+        self.rng = np.random.default_rng(seed)
+        self.radius = radius
+        self.noise = noise
+        self.A = np.eye(3) + self.rng.normal(0, distortion, [3, 3])
+        self.offset = self.rng.normal(0, radius, 3)
+
+    def samples(self, n) -> np.ndarray:
+        """
+        :param n: int, Number of samples
+        :return: (n, 3) array
+        """
+        v = self.rng.normal(size=[n, 3])
+        v /= np.linalg.norm(v, axis=1)[:, None]
+        return self.radius * v @ self.A.T + self.offset + self.rng.normal(0, self.noise, [n, 3])
+
+
+def synthetic_ellipsoid(n, radius=50.0, noise=0.5, seed=0) -> np.ndarray:
+    """
+    Samples of a sensor rotated in all directions, with a random soft-iron
+    matrix, hard-iron offset and white noise
+    :param n: int, Number of samples
+    :return: (n, 3) array
+    """
+    return SyntheticSensor(radius, noise, seed=seed).samples(n)
+
+
+def format_lines(samples, delimiter=",", error_rate=0.0, rng=None, fmt="%.3f"):
+    """
+    CSV lines as sent by the sensor firmware, a share of them corrupted
+    :param samples: (n, nchannels) array
+    :param error_rate: float, Probability of a line being truncated or garbled
+    :param fmt: string, printf format of one value
+    :return: bytes and the number of corrupted lines
+    """
+    n, nchannels = samples.shape
+    if n == 0:
+        return b"", 0
+    # One format operation for the whole block, the lines are only split up to corrupt some
+    line = delimiter.replace("%", "%%").join([fmt] * nchannels)
+    text = ("\r\n".join([line] * n) + "\r\n") % tuple(samples.ravel().tolist())
+    n_bad = 0
+    if error_rate > 0:
+        lines = text.split("\r\n")[:-1]
+        rng = np.random.default_rng() if rng is None else rng
+        for i in np.flatnonzero(rng.random(len(lines)) < error_rate):
+            kind = rng.integers(3)
+            if kind == 0:
+                lines[i] = lines[i][:len(lines[i]) // 2]
+            elif kind == 1:
+                lines[i] = lines[i].replace(delimiter, "", 1)
+            else:
+                lines[i] = "#%x!" % rng.integers(1 << 30)
+            n_bad += 1
+        text = "\r\n".join(lines) + "\r\n"
+    return text.encode("utf-8"), n_bad
+
+
+class SimulatedDevice(threading.Thread):
+
+    """Writes synthetic sensor data to a pseudo terminal at a given rate"""
+
+    def __init__(self, rate=100.0, n_samples=None, radius=50.0, noise=0.5, error_rate=0.0,
+                 delimiter=",", protocol="ascii", block=256, seed=0):
+
+        """
+        :param rate: float or None, Samples per second, None sends as fast as the
+        reader accepts them
+        :param n_samples: int or None, Stop after this many samples, None runs until stop()
+        :param radius: float, Field magnitude
+        :param noise: float, Noise on every axis
+        :param error_rate: float, Share of corrupted lines, ascii protocol only
+        :param delimiter: string, Delimiter of the lines
+        :param protocol: string, "ascii" or "binary" frames with int16 values
+        :param block: int, Samples written at once when sending as fast as possible
+        :param seed: int, Seed of the data
+        """
+        super().__init__(daemon=True)
+        if tty is None:
+            raise OSError("The simulated device needs pseudo terminals, which this system lacks")
+        self.master, self.slave = os.openpty()
+        # Raw mode, no echo and no newline translation on the pseudo terminal
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.rate = rate
+        self.n_samples = n_samples
+        self.error_rate = error_rate
+        self.delimiter = delimiter
+        self.protocol = protocol
+        self.block = block
+        self.sensor = SyntheticSensor(radius, noise, seed=seed)
+        self.rng = np.random.default_rng(seed + 1)
+
+        self.sent = 0
+        self.corrupted = 0
+        # Good samples sent so far and time.monotonic() after every write
+        self.write_log = []
+        self.__stop_event = threading.Event()
+
+    def __encode(self, samples):
+        if self.protocol == "binary":
+            return encode_frames(samples, start_counter=self.sent, scale=0.01), 0
+        return format_lines(samples, self.delimiter, self.error_rate, self.rng)
+
+    def run(self):
+        t0 = time.monotonic()
+        while not self.__stop_event.is_set():
+            if self.rate is None:
+                n = self.block
+            else:
+                n = int((time.monotonic() - t0) * self.rate) - self.sent
+            if self.n_samples is not None:
+                n = min(n, self.n_samples - self.sent)
+                if n <= 0 and self.sent >= self.n_samples:
+                    break
+            if n <= 0:
+                time.sleep(0.001)
+                continue
+            raw, n_bad = self.__encode(self.sensor.samples(n))
+            try:
+                while len(raw) > 0:
+                    raw = raw[os.write(self.master, raw):]
+            except OSError:
+                break
+            self.sent += n
+            self.corrupted += n_bad
+            self.write_log.append((self.sent - self.corrupted, time.monotonic()))
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.is_alive():
+            self.join(2.0)
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+if __name__ == "__main__":
+    device = SimulatedDevice()
+    device.start()
+    print("Simulated magnetometer on %s, Ctrl+C to stop" % device.port)
+    try:
+        while device.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        device.close()
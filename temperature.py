@@ -0,0 +1,181 @@
+# Temperature compensated calibration. The samples of a temperature sweep are
+# binned by temperature, every bin is fitted on its own (all at once with
+# fit_ellipsoid_batch) and low order polynomials in T are fitted through the
+# entries of the per bin U and c. U is the scaled Cholesky factor with its
+# upper triangle copied to the lower one, so it is symmetric and all nine
+# entries are interpolated, each varying smoothly with temperature.
+
+import numpy as np
+from fit_ellipsoid import fit_ellipsoid_batch, FIT_OK
+
+
+def temperature_bins(T, width=5.0, edges=None):
+    """
+    :param T: (n,) array of temperatures
+    :param width: float, Bin width in degrees, used when no edges are given
+    :param edges: array or None, Bin edges
+    :return: edges and the (n,) bin index of every sample, -1 outside the edges
+    """
+    if edges is None:
+        lo = np.floor(T.min() / width) * width
+        hi = np.ceil(T.max() / width) * width
+        edges = np.arange(lo, max(hi, lo + width) + width / 2, width)
+    edges = np.asarray(edges, dtype=float)
+    index = np.searchsorted(edges, T, side='right') - 1
+    # The upper edge belongs to the last bin
+    index[T == edges[-1]] = len(edges) - 2
+    index[(index < 0) | (index > len(edges) - 2)] = -1
+    return edges, index
+
+
+def fit_temperature_bins(X, T, width=5.0, edges=None, min_samples=500) -> dict:
+    """
+    One calibration per temperature bin
+    :param X: (n, >=3) array of samples
+    :param T: (n,) array of temperatures
+    :param min_samples: int, Bins with fewer samples are not fitted
+    :return: dict of arrays, bin edges, mean temperature, sample count, U (K, 3, 3),
+    c (K, 3) and status (K,) of the K populated bins, unscaled like fit_ellipsoid
+    """
+    edges, index = temperature_bins(T, width, edges)
+    counts = np.bincount(index[index >= 0], minlength=len(edges) - 1)
+    used = np.flatnonzero(counts >= min_samples)
+    order = np.argsort(index, kind='stable')
+    starts = np.searchsorted(index[order], used)
+    groups = [X[order[s:s + counts[k]], :3] for s, k in zip(starts, used)]
+    centers = np.array([T[order[s:s + counts[k]]].mean() for s, k in zip(starts, used)])
+    if len(groups) == 0:
+        U, c, status = np.zeros([0, 3, 3]), np.zeros([0, 3]), np.zeros(0, dtype=int)
+    else:
+        U, c, status = fit_ellipsoid_batch(groups)
+    return {"edges": edges, "T": centers, "samples": counts[used], "U": U, "c": c, "status": status}
+
+
+class TemperatureModel:
+
+    """Calibration with U and c polynomial in the temperature"""
+
+    def __init__(self, coefficients, t0=0.0, t_scale=1.0, t_range=(-np.inf, np.inf)):
+
+        """
+        :param coefficients: (degree + 1, 12) array, Polynomial coefficients
+        of the nine entries of U followed by the three of c, lowest order first,
+        in the normalized temperature (T - t0) / t_scale
+        :param t0: float, Center of the normalization
+        :param t_scale: float, Scale of the normalization
+        :param t_range: tuple, Temperatures the model was fitted on, inputs are
+        clipped to it so the polynomials are never extrapolated
+        """
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.degree = len(self.coefficients) - 1
+        self.t0 = t0
+        self.t_scale = t_scale
+        self.t_range = t_range
+
+    def __basis(self, T):
+        t = (np.clip(np.asarray(T, dtype=float), *self.t_range) - self.t0) / self.t_scale
+        return t[..., None] ** np.arange(self.degree + 1)
+
+    def evaluate(self, T):
+        """
+        :param T: float or (n,) array of temperatures
+        :return: U (..., 3, 3) and c (..., 3)
+        """
+        p = self.__basis(T) @ self.coefficients
+        return p[..., :9].reshape(p.shape[:-1] + (3, 3)), p[..., 9:]
+
+    def apply(self, X, T, out=None, chunk=16384):
+        """
+        Correct every sample with the calibration at its own temperature
+        :param X: (n, >=3) array of samples
+        :param T: (n,) array of temperatures
+        :param out: (n, 3) array or None
+        :param chunk: int, Samples per block, small enough for the temporaries to stay in cache
+        :return: (n, 3) array of calibrated samples
+        """
+        if out is None:
+            out = np.empty([len(X), 3])
+        C = self.coefficients.T
+        for i in range(0, len(X), chunk):
+            t = (np.clip(T[i:i + chunk], *self.t_range) - self.t0) / self.t_scale
+            # Powers of t as rows, so every entry of U and c below is a contiguous row
+            V = np.empty([self.degree + 1, len(t)])
+            V[0] = 1
+            for k in range(1, self.degree + 1):
+                np.multiply(V[k - 1], t, out=V[k])
+            p = C @ V
+            Y = X[i:i + chunk, :3].T - p[9:]
+            for j in range(3):
+                o = out[i:i + chunk, j]
+                np.multiply(Y[0], p[j], out=o)
+                o += Y[1] * p[3 + j]
+                o += Y[2] * p[6 + j]
+        return out
+
+    def scaled(self, field):
+        """
+        :param field: float, Factor on U, e.g. the field strength for a model fitted with field 1
+        :return: TemperatureModel
+        """
+        coefficients = self.coefficients.copy()
+        coefficients[:, :9] *= field
+        return TemperatureModel(coefficients, self.t0, self.t_scale, self.t_range)
+
+    def to_dict(self) -> dict:
+        return {"degree": self.degree, "t0": self.t0, "t_scale": self.t_scale,
+                "t_range": [float(t) for t in self.t_range],
+                "U": self.coefficients[:, :9].reshape(-1, 3, 3).tolist(),
+                "c": self.coefficients[:, 9:].tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        coefficients = np.concatenate([np.reshape(d["U"], (-1, 9)), np.reshape(d["c"], (-1, 3))], axis=1)
+        return cls(coefficients, d["t0"], d["t_scale"], tuple(d["t_range"]))
+
+
+def fit_temperature_model(table, degree=2, field=1.0):
+    """
+    Weighted least squares polynomials through the per bin calibrations
+    :param table: dict from fit_temperature_bins
+    :param degree: int, Polynomial degree, lowered if there are too few bins
+    :param field: float, Scale of U, the magnitude of the field during the sweep
+    :return: TemperatureModel or None if no bin could be fitted
+    """
+    ok = table["status"] == FIT_OK
+    if np.count_nonzero(ok) == 0:
+        print("No temperature bin could be fitted. Need more data or retake trial")
+        return None
+    T = table["T"][ok]
+    degree = min(degree, len(T) - 1)
+    t0 = float(T.mean())
+    t_scale = float(max(np.ptp(T) / 2, 1.0))
+    V = ((T - t0) / t_scale)[:, None] ** np.arange(degree + 1)
+    P = np.concatenate([field * table["U"][ok].reshape(-1, 9), table["c"][ok]], axis=1)
+    w = np.sqrt(table["samples"][ok])[:, None]
+    coefficients = np.linalg.lstsq(w * V, w * P, rcond=None)[0]
+    return TemperatureModel(coefficients, t0, t_scale, (float(T.min()), float(T.max())))
+
+
+def fit_temperature_compensation(X, T, width=5.0, degree=2, field=1.0, min_samples=500, reject=None):
+    """
+    Bin, fit and model in one go
+    :param X: (n, >=3) array of samples
+    :param T: (n,) array of temperatures
+    :param reject: float or None, Fit again without the samples whose calibrated
+    magnitude is off by more than this fraction. One ellipsoid does not fit a
+    whole sweep, so outliers are judged by the model rather than a robust fit.
+    :return: TemperatureModel or None, the table of the per bin fits and the
+    (n,) mask of the samples used
+    """
+    inliers = np.ones(len(X), dtype=bool)
+    table = fit_temperature_bins(X, T, width, min_samples=min_samples)
+    model = fit_temperature_model(table, degree, field)
+    if model is not None and reject is not None:
+        inliers = np.abs(np.linalg.norm(model.apply(X, T), axis=1) / field - 1) < reject
+        table = fit_temperature_bins(X[inliers], T[inliers], width, min_samples=min_samples)
+        model = fit_temperature_model(table, degree, field)
+    return model, table, inliers
+
+
+if __name__ == "__main__":
+    print("Temperature compensated calibration")
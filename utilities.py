@@ -1,5 +1,10 @@
+from functools import lru_cache
 import numpy as np
 
+# Bytes that count as blank around a value, including the \r the firmware ends lines with
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[list(b" \t\r\n\v\f")] = True
+
 
 def convert_to_array(raw_line, delimiter=","):
     dt = raw_line.split(delimiter)
@@ -10,6 +15,68 @@ def convert_to_array(raw_line, delimiter=","):
         return None
 
 
+def parse_lines(lines, nchannels, delimiter=","):
+    """
+    Parse a batch of raw serial lines into one array with a single
+    vectorized conversion. Rows with the wrong number of fields or values
+    that are not numbers are skipped.
+    :param lines: list of bytes, Complete lines without the newline
+    :param nchannels: int, Number of values expected on every line
+    :param delimiter: string, Delimiter between the values of a line
+    :return: (n, nchannels) float array and the number of rejected lines
+    """
+    delim = delimiter.encode('utf-8')
+    empty = np.zeros([0, nchannels], dtype=float)
+    if len(lines) == 0:
+        return empty, 0
+
+    # Fast path, every row holds exactly nchannels fields. The delimiters per
+    # row are counted on the raw bytes, and turning the line breaks into
+    # delimiters then gives one flat run of fields in row-major order.
+    buf = b"\n".join(lines)
+    if len(delim) == 1:
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        is_delim = raw == delim[0]
+        seen = np.cumsum(is_delim)
+        is_break = raw == 10
+        ends = seen[np.flatnonzero(is_break)]
+        per_row = np.diff(np.concatenate([[0], ends, seen[-1:]]))
+        # np.fromstring reads an empty or blank field as -1, e.g. of a line
+        # cut short after its last delimiter, so every field needs a non blank byte
+        is_sep = is_delim | is_break
+        field = np.cumsum(is_sep)
+        filled = np.bincount(field[~(WHITESPACE[raw] | is_sep)], minlength=field[-1] + 1 if len(field) else 1)
+        blank = np.any(filled == 0)
+    else:
+        per_row = np.array([ln.count(delim) for ln in lines])
+        blank = any(not f.strip() for f in buf.replace(b"\n", delim).split(delim))
+    if not blank and np.all(per_row == nchannels - 1):
+        try:
+            data = np.fromstring(buf.replace(b"\n", delim), dtype=float, sep=delimiter)
+            if len(data) == len(lines) * nchannels:
+                return data.reshape(-1, nchannels), 0
+        except ValueError:
+            pass
+
+    # Slow path, drop blank lines, rows with the wrong number of fields
+    # and rows holding something that is not a number
+    rows = [ln for ln in lines if ln.strip()]
+    n_bad = 0
+    data = []
+    for ln in rows:
+        try:
+            row = np.array(ln.split(delim), dtype=bytes).astype(float)
+        except ValueError:
+            row = None
+        if row is None or len(row) != nchannels:
+            n_bad += 1
+            continue
+        data.append(row)
+    if len(data) == 0:
+        return empty, n_bad
+    return np.stack(data), n_bad
+
+
 def matrix_string(mat):
     mat_str = np.array2string(mat, precision=4, separator="  ", prefix="", suffix="",
                               formatter={'float_kind': lambda x: "%.4f" % x})
@@ -18,22 +85,29 @@ def matrix_string(mat):
     mat_str = " " + mat_str
     return mat_str
 
-def generate_ellispoid(A, c, r):
+@lru_cache(maxsize=8)
+def unit_sphere(resolution=100):
+    """
+    Mesh of the unit sphere, computed once per resolution. The arrays are
+    shared between callers and therefore read only.
+    :param resolution: int, Number of steps from pole to pole
+    :return: (2 * resolution + 1, resolution + 1, 3) array
+    """
+    theta = np.linspace(0, np.pi, resolution + 1)
+    phi = np.linspace(0, 2 * np.pi, 2 * resolution + 1)
 
-    delta_theta = np.pi / 100
-    delta_phi = np.pi / 100
+    theta, phi = np.meshgrid(theta, phi)
+    sphere = np.stack([np.cos(phi) * np.sin(theta), np.sin(phi) * np.sin(theta), np.cos(theta)], axis=-1)
+    sphere.flags.writeable = False
+    return sphere
 
-    theta = np.arange(0, np.pi + delta_theta, delta_theta)
-    phi = np.arange(0, 2 * np.pi + delta_phi, delta_phi)
 
-    theta, phi = np.meshgrid(theta, phi)
-    x = r * np.cos(phi) * np.sin(theta)
-    y = r * np.sin(phi) * np.sin(theta)
-    z = r * np.cos(theta)
-
-    # Convert to ellipsoid and replot
-    sphere_data = np.concatenate([np.expand_dims(x, 2), np.expand_dims(y, 2), np.expand_dims(z, 2)], axis=-1)
-    ellipsoid_data = np.tensordot(sphere_data, np.linalg.inv(A), axes=((2), (0))) + c
-    xprime, yprime, zprime = np.split(ellipsoid_data, axis=-1, indices_or_sections=3)
+def generate_ellispoid(A, c, r, resolution=100):
+
+    sphere_data = r * unit_sphere(resolution)
+
+    # Convert to ellipsoid with one affine transform, x A = s solved for x
+    ellipsoid_data = np.linalg.solve(A.T, sphere_data.reshape(-1, 3).T).T.reshape(sphere_data.shape) + c
     # Return all the parameters
-    return x, y, z, xprime[:, :, 0], yprime[:, :, 0], zprime[:, :, 0]
\ No newline at end of file
+    return (sphere_data[:, :, 0], sphere_data[:, :, 1], sphere_data[:, :, 2],
+            ellipsoid_data[:, :, 0], ellipsoid_data[:, :, 1], ellipsoid_data[:, :, 2])